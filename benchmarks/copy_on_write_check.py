@@ -0,0 +1,64 @@
+import os
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+##############################
+#
+# 生成したコードによる分析用のデータの変更が、元のデータに反映されないことを確認する
+# 1. Copy-on-Writeを無効にした状態でcode_workers.executeを呼び出し、値の変更・カラムの追加後も元のDataFrameが変わらないこと
+# 2. ワーカープロセスでデータを変更するコードを実行した後、次の実行で変更前のデータが参照されること
+# 実行例: python benchmarks/copy_on_write_check.py
+#
+##############################
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import functions.code_workers as cw
+
+# 分析用のデータを変更するコード
+WRITE_CODE = """
+df.loc[0, 'value'] = -1
+df['value'] *= 100
+df['new'] = 1
+df.drop(columns=['label'], inplace=True)
+print(df['value'].iloc[0], df.shape)
+"""
+READ_CODE = "print(df['value'].iloc[0], df.shape)"
+
+def make_data():
+    return pd.DataFrame({'value': np.arange(10, dtype='float64'), 'label': list('abcdefghij')})
+
+# 1. executeで実行した場合(他のモジュールでCopy-on-Writeが有効にされていない状態)
+def check_execute():
+    pd.set_option('mode.copy_on_write', False)
+    df = make_data()
+    expected = df.copy()
+    output, _ = cw.execute(WRITE_CODE, df, {})
+    assert "Error" not in output, output
+    pd.testing.assert_frame_equal(df, expected)
+    print(f"execute: 変更後の出力 {output.strip()} / 元のデータは変更なし")
+
+# 2. ワーカープロセスで実行した場合
+def check_worker(shared_dir):
+    path = os.path.join(shared_dir, 'dataset.arrow')
+    table = pa.Table.from_pandas(make_data())
+    with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    pool = cw.WorkerPool(1)
+    written, _ = pool.run(WRITE_CODE, path, {})
+    read, _ = pool.run(READ_CODE, path, {})
+    assert "Error" not in written, written
+    assert read.strip() == "0.0 (10, 2)", read
+    print(f"worker: 変更後の出力 {written.strip()} / 次の実行の出力 {read.strip()}")
+
+def main():
+    check_execute()
+    with tempfile.TemporaryDirectory() as shared_dir:
+        check_worker(shared_dir)
+    print("OK")
+
+if __name__ == '__main__':
+    main()
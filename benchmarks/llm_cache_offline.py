@@ -0,0 +1,81 @@
+import argparse
+import os
+import sys
+import tempfile
+
+##############################
+#
+# コード生成結果のキャッシュ(functions/llm_cache.py)をオフラインで確認する
+# APIを呼び出さないスタブのLLM(呼び出し回数を数える)をgenerate_codeに渡し、同じ分析内容を繰り返し生成する
+# 実行に失敗したコードはキャッシュされないこと、成功したコードは次回からLLMを呼び出さずに同じコードを返すこと、
+# キャッシュを使用しない指定(use_cache=False)の場合はLLMを呼び出すことを確認する
+# 実行例: python benchmarks/llm_cache_offline.py --query "売上の合計を集計してください"
+#
+##############################
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# AppTestで実行するページ(関数の本体のみが実行されるため、必要なものは関数内でimportする)
+def app():
+    import os
+    import streamlit as st
+    from langchain_community.llms.fake import FakeListLLM
+    import functions.func_chatbot as fc
+
+    # 呼び出し回数を数えるスタブのLLM
+    class CountingLLM(FakeListLLM):
+        calls: int = 0
+
+        def _call(self, *args, **kwargs):
+            self.calls += 1
+            return super()._call(*args, **kwargs)
+
+    query = os.environ['LLM_CACHE_CHECK_QUERY']
+    st.session_state.numeric_columns = ['Quantity', 'Unit_Price']
+    st.session_state.non_numeric_columns = ['Customer_ID']
+    st.session_state.datetime_columns = ['Date']
+    fc.init_messages(True)
+
+    llm = CountingLLM(responses=["```python\nimport streamlit as st\nst.write(df['Quantity'].sum())\n```"])
+    codes, calls = [], []
+    # 前後の空白・全角の空白のみ異なる分析内容(正規化によって同じキーになる)
+    # (生成したコードは実行せず、実行結果をupdate_cacheに渡してキャッシュを更新する)
+    steps = [
+        (query, "Error: 実行に失敗", True),      # 失敗したコードはキャッシュしない
+        (f"  {query}　", "", True),             # 再度LLMを呼び出し、成功したコードをキャッシュする
+        (f"{query}  ", "", True),               # キャッシュを使用する
+        (query, "", False),                     # キャッシュを使用しない
+    ]
+    for text, result, use_cache in steps:
+        st.session_state.messages.append({"role": "user", "content": text})
+        codes.append(fc.generate_code(text, llm=llm, use_cache=use_cache))
+        fc.update_cache(result)
+        st.session_state.messages.pop()
+        calls.append(llm.calls)
+    st.session_state.check_result = {'codes': codes, 'calls': calls,
+                                     'usage': [usage['キャッシュ使用'] for usage in st.session_state.token_usage]}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--query', default="売上の合計を集計してください")
+    args = parser.parse_args()
+
+    from streamlit.testing.v1 import AppTest
+    with tempfile.TemporaryDirectory() as cache_dir:
+        # functions.llm_cacheのimport前に、キャッシュの保存先を一時ディレクトリに変更する
+        os.environ['VIRTUAL_ANALYST_LLM_CACHE_DIR'] = cache_dir
+        os.environ['LLM_CACHE_CHECK_QUERY'] = args.query
+        at = AppTest.from_function(app, default_timeout=60).run()
+        if at.exception:
+            raise RuntimeError(at.exception[0].message)
+        result = at.session_state.check_result
+
+    print(f"LLMの呼び出し回数(累計): {result['calls']}, キャッシュ使用: {result['usage']}")
+    assert result['calls'] == [1, 2, 2, 3], "キャッシュの保存・使用の条件が想定と異なります"
+    assert result['usage'] == [False, False, True, False]
+    assert result['codes'][1] == result['codes'][2]
+    print("OK")
+
+if __name__ == '__main__':
+    main()
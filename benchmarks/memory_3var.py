@@ -0,0 +1,90 @@
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import numpy as np
+import pandas as pd
+
+##############################
+#
+# 3変数の集計関数・クロス集計のピーク時のメモリ使用量(RSS)を計測する
+# 計測ケース毎に別プロセスで実行し、データ作成後のRSSと集計中のピークRSSの差を比較する
+# 実行例: python benchmarks/memory_3var.py --rows 200000 --columns 200
+#
+##############################
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+CASES = ['full_copy', 'cross_counts', 'agg_category_2col_dataframe', 'agg_category_datetime_dataframe']
+
+# 計測用のデータを作成する(数値型のカラムを多数持つ横長のデータ)
+def make_data(rows, columns):
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(rng.normal(size=(rows, columns)), columns=[f'num_{i}' for i in range(columns)])
+    return df.assign(
+        cat1=rng.choice(list('abcdefghij'), rows),
+        cat2=rng.choice(list('vwxyz'), rows),
+        date=pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 365 * 24, rows), unit='h'),
+    )
+
+# ピークRSS(MB)を取得する
+# Linuxではデータ作成時のピークを計測に含めないよう、計測開始時にピークをリセットする
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass # リセットできない環境ではプロセス開始からのピークを使用する
+
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # Linux以外: ru_maxrss(macOSはbyte単位, それ以外はkilobyte単位)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024
+
+# 1つのケースを実行し、集計によって増加したピークRSSを出力する
+def run_case(case, rows, columns):
+    import functions.func_base_analysis as fba
+
+    df = make_data(rows, columns)
+    reset_peak_rss()
+    before = peak_rss_mb()
+    if case == 'full_copy':
+        # 変更前の3変数の集計関数が最初に行っていた、DataFrame全体のコピー
+        df.copy()
+    elif case == 'cross_counts':
+        fba.cross_counts(df, 'cat1', 'cat2')
+    elif case == 'agg_category_2col_dataframe':
+        fba.agg_category_2col_dataframe(df, 'cat1', 'cat2', 'num_0', '合計')
+    elif case == 'agg_category_datetime_dataframe':
+        fba.agg_category_datetime_dataframe(df, 'cat1', 'date', 'num_0', '平均', 0.05, '月')
+    print(f'{peak_rss_mb() - before:.1f}')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=200_000)
+    parser.add_argument('--columns', type=int, default=200)
+    parser.add_argument('--case', choices=CASES)
+    args = parser.parse_args()
+
+    if args.case:
+        run_case(args.case, args.rows, args.columns)
+        return
+
+    print(f'rows={args.rows:,} columns={args.columns} データサイズ: {8 * args.rows * args.columns / 1024**2:.1f} MB')
+    for case in CASES:
+        result = subprocess.run(
+            [sys.executable, __file__, '--case', case, '--rows', str(args.rows), '--columns', str(args.columns)],
+            capture_output=True, text=True, check=True,
+        )
+        print(f'{case:<35} ピークRSSの増加: {result.stdout.strip().splitlines()[-1]:>8} MB')
+
+if __name__ == '__main__':
+    main()
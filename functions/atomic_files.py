@@ -0,0 +1,40 @@
+import os
+import time
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+
+##############################
+#
+# キャッシュのファイルの書き込み(data_cache・llm_cache・code_workersで共通)
+# 書き込み途中のファイルを他のセッション・ワーカーが読み込まないよう、一時ファイルに書き込んでから置き換える
+# セッションは同じプロセス内のスレッドのため、一時ファイルの名前は書き込み毎に異なるもの(mkstemp)にする
+#
+##############################
+
+# 一時ファイルを書き込み中とみなす期間(秒, これより古い一時ファイルは中断された書き込みとして削除する)
+STALE_TMP_SECONDS = 60 * 60
+
+# pathに書き込むための一時ファイルのパスを返し、with文を抜けた時点でpathに置き換える
+# with文の中で例外が発生した場合は一時ファイルを削除し、pathは変更しない
+@contextmanager
+def atomic_path(path):
+    path = Path(path)
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=f"{path.name}.", suffix='.tmp')
+    os.close(fd)
+    tmp_path = Path(tmp_name)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+# プロセスの強制終了などで残った一時ファイルを削除する
+def evict_tmp_files(directory, max_age=STALE_TMP_SECONDS):
+    now = time.time()
+    for path in Path(directory).glob("*.tmp"):
+        try:
+            if now - path.stat().st_mtime > max_age:
+                path.unlink(missing_ok=True)
+        except FileNotFoundError:
+            continue # 書き込みが完了して置き換え済み
@@ -0,0 +1,156 @@
+import streamlit as st
+
+##############################
+#
+# コード生成時にLLMへ渡す会話の履歴(コンテキスト)の作成
+# 会話の履歴を「分析内容 → 生成したコード → 実行結果(エラー時は再生成を繰り返す)」の単位(ターン)にまとめ、
+# 再生成で置き換えられたコード・エラーは除外し、最後のコードと実行結果のみを残す(エラーの内容は生成したコードに関する部分に絞る)
+# トークン数の上限に収まる範囲で新しいターンから順に含め、収まらない古いターンは要約(分析内容の一覧)に移す
+# 要約はセッション内で追記していき、リクエスト毎に作り直さない
+#
+##############################
+
+# 会話の履歴に使用するトークン数の上限
+CONTEXT_TOKEN_BUDGET = 3000
+# 要約に使用するトークン数の上限(超えた場合は古い分析内容から削除する)
+SUMMARY_TOKEN_BUDGET = 500
+# 実行結果・エラーの最大文字数(超えた場合は先頭と末尾のみ残す)
+MAX_RESULT_CHARS = 1500
+# エラーのトレースバックに残す、生成したコード以外のフレームの数(例外が発生した箇所から数える)
+TRACEBACK_LIBRARY_FRAMES = 1
+# 要約に含める分析内容の最大文字数
+MAX_SUMMARY_QUERY_CHARS = 200
+
+##### トークン数
+# tiktokenがインストールされている場合はモデルのトークナイザーで数え、無い場合は概算する
+# (概算: 日本語は1文字1トークン程度・英数字は3文字1トークン以下となるよう、UTF-8のバイト数を3で割る)
+def count_tokens(text, model_name=None):
+    try:
+        import tiktoken
+    except ImportError:
+        return len(text.encode('utf-8')) // 3 + 1
+    try:
+        encoding = tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        encoding = tiktoken.get_encoding('cl100k_base')
+    return len(encoding.encode(text))
+
+def count_message_tokens(messages, model_name=None):
+    return sum(count_tokens(message['content'], model_name) for message in messages)
+
+##### 実行結果の短縮
+# トレースバックを、生成したコード(<string>)のフレームと例外が発生した箇所のフレーム・例外の内容に絞る
+# 例外が連鎖している場合は、最後のトレースバックのみ残す
+def truncate_traceback(text):
+    header = 'Traceback (most recent call last):'
+    lines = text.splitlines()
+    if header not in lines:
+        return text
+    start = len(lines) - 1 - lines[::-1].index(header)
+    # フレーム毎の行(File ...の行とそれに続くコードの行)に分ける
+    frames, tail = [], []
+    for line in lines[start + 1:]:
+        if line.startswith('  File '):
+            frames.append([line])
+        elif line.startswith('    ') and frames and not tail:
+            frames[-1].append(line)
+        else:
+            tail.append(line)
+    code_frames = [i for i, frame in enumerate(frames) if 'File "<string>"' in frame[0]]
+    keep = set(code_frames) | set(range(len(frames) - TRACEBACK_LIBRARY_FRAMES, len(frames)))
+    kept_lines = [lines[start]]
+    for i, frame in enumerate(frames):
+        if i in keep:
+            kept_lines.extend(frame)
+        elif kept_lines[-1] != '  ...':
+            kept_lines.append('  ...')
+    return '\n'.join(kept_lines + tail)
+
+# 実行結果を短縮する(エラーはトレースバックを絞った上で、最大文字数を超える場合は先頭と末尾のみ残す)
+def shorten_result(text):
+    text = truncate_traceback(text)
+    if len(text) <= MAX_RESULT_CHARS:
+        return text
+    half = MAX_RESULT_CHARS // 2
+    return f"{text[:half]}\n...(中略: {len(text) - MAX_RESULT_CHARS}文字)...\n{text[-half:]}"
+
+##### 会話の履歴の作成
+# メッセージをターン毎にまとめる(再生成の指示のメッセージは直前のターンに含める)
+# メッセージのkind: 'code'→生成したコード, 'result'→実行結果, 'retry'→エラー時の再生成の指示
+def split_turns(messages):
+    turns = []
+    for message in messages:
+        if message['role'] == 'user' and message.get('kind') != 'retry':
+            turns.append({'query': message['content'], 'code': None, 'result': None})
+        elif not turns:
+            continue
+        elif message.get('kind') == 'code':
+            turns[-1]['code'] = message['content']
+            turns[-1]['result'] = None # 再生成したコードで置き換え、前のコードの実行結果は除外する
+        elif message.get('kind') == 'result':
+            turns[-1]['result'] = message['content']
+    return turns
+
+# ターンをLLMに渡すメッセージに変換する
+# exclude: プロンプト内に含めるため、会話の履歴から除外するコード・実行結果
+def turn_messages(turn, exclude=()):
+    messages = [{'role': 'user', 'content': turn['query']}]
+    if turn['code'] is not None and turn['code'] not in exclude:
+        messages.append({'role': 'assistant', 'content': turn['code']})
+    if turn['result'] is not None and turn['result'] not in exclude:
+        messages.append({'role': 'assistant', 'content': shorten_result(turn['result'])})
+    return messages
+
+# 要約に追記する1行(分析内容と、エラーで終了したかどうか)
+def summary_line(turn):
+    query = turn['query'][:MAX_SUMMARY_QUERY_CHARS]
+    failed = turn['result'] is not None and "Error" in turn['result']
+    return f"- {query}" + (" (エラーで終了)" if failed else "")
+
+# 会話の履歴を作成する
+# 戻り値: {'messages': LLMに渡すメッセージ, 'summary': 要約(無い場合は空文字), 'stats': トークン数などの記録}
+def build_context(messages, model_name=None, exclude=()):
+    turns = split_turns(messages)
+    state = st.session_state.setdefault('chat_summary', {'turns': 0, 'lines': []})
+
+    # 新しいターンから順に、トークン数の上限に収まる範囲で含める(要約済みのターンは含めない)
+    start, used = len(turns), 0
+    while start > state['turns']:
+        tokens = count_message_tokens(turn_messages(turns[start - 1], exclude), model_name)
+        if used + tokens > CONTEXT_TOKEN_BUDGET:
+            break
+        start -= 1
+        used += tokens
+
+    # 含めなかったターンのうち、要約していないものを要約に追記する
+    for turn in turns[state['turns']:start]:
+        state['lines'].append(summary_line(turn))
+    state['turns'] = max(state['turns'], start)
+    while state['lines'] and count_tokens('\n'.join(state['lines']), model_name) > SUMMARY_TOKEN_BUDGET:
+        state['lines'].pop(0)
+
+    context_messages = [message for turn in turns[start:] for message in turn_messages(turn, exclude)]
+    summary = '\n'.join(state['lines'])
+    stats = {
+        'ターン数': len(turns),
+        '履歴に含めたターン数': len(turns) - start,
+        '履歴のトークン数': used,
+        '要約のトークン数': count_tokens(summary, model_name) if summary else 0,
+        '元の履歴のトークン数': count_message_tokens(messages, model_name),
+    }
+    return {'messages': context_messages, 'summary': summary, 'stats': stats}
+
+##### トークン数の記録
+# リクエスト毎のトークン数を記録する(st.session_state.token_usage)
+# callback: APIの呼び出しで実際に使用したトークン数(キャッシュを使用した場合はNone)
+def record_usage(kind, context, prompt, model_name=None, callback=None):
+    usage = {
+        '種類': kind,
+        'プロンプトのトークン数': count_tokens(prompt, model_name),
+        **context['stats'],
+        'キャッシュ使用': callback is None,
+        'API入力トークン数': callback.prompt_tokens if callback is not None else 0,
+        'API出力トークン数': callback.completion_tokens if callback is not None else 0,
+    }
+    st.session_state.setdefault('token_usage', []).append(usage)
+    return usage
@@ -0,0 +1,325 @@
+import os
+import sys
+import types
+import threading
+import hashlib
+import multiprocessing
+from contextlib import contextmanager
+from pathlib import Path
+import streamlit as st
+import pandas as pd
+import pyarrow as pa
+import functions.data_version as dv
+import functions.atomic_files as af
+
+##############################
+#
+# Chatbotで生成したコードを実行するワーカープロセスのプール
+# ワーカーは分析用のライブラリをimportした状態で待機し、生成したコードをstreamlitとは別のプロセスで実行する
+# 分析用のデータはバージョン毎に1度だけArrow形式のファイルに書き出し、ワーカーはメモリマップで読み込む(実行毎にデータを受け渡さない)
+# 実行時間・メモリ使用量の上限を超えた場合はワーカーを終了し、新しいワーカーに置き換える
+#
+##############################
+
+# ワーカーの数
+WORKER_COUNT = int(os.environ.get("VIRTUAL_ANALYST_WORKERS", 2))
+# 1回の実行時間の上限(秒)
+EXECUTION_TIMEOUT_SECONDS = int(os.environ.get("VIRTUAL_ANALYST_WORKER_TIMEOUT", 120))
+# ワーカー1つのメモリ使用量の上限(byte, メモリマップで読み込んだデータは含まない)
+WORKER_MAX_MEMORY_BYTES = int(os.environ.get("VIRTUAL_ANALYST_WORKER_MAX_MEMORY", 4 * 1024**3))
+# ワーカーと共有するデータの保存先
+SHARED_DIR = Path(os.environ.get("VIRTUAL_ANALYST_WORKER_DIR", ".cache/worker_datasets"))
+# 保存しておくデータの数(古いものから削除する)
+MAX_SHARED_DATASETS = 8
+# ワーカーで事前にimportしておくライブラリ
+PRELOAD_MODULES = ['numpy', 'pandas', 'matplotlib.pyplot', 'seaborn', 'sklearn', 'statsmodels.api',
+                   'langchain_experimental.utilities', 'functions.execution_snapshot']
+
+##### コードの実行(ワーカープロセス)
+# 生成したコードに渡す分析用のデータ
+# Copy-on-Write(executeの実行中は有効にする)により、元のデータとメモリを共有したまま新しいDataFrameとして扱う(読み取りのみの場合はコピーが発生しない)
+# カラムの追加・値の変更を行った場合は変更した部分のみがコピーされ、元のデータ(st.session_state.df・ワーカーが保持するデータ)は変更されない
+def dataset_handle(df):
+    return df.copy(deep=False) if df is not None else None
+
+# 生成したコードを実行し、標準出力と表示する要素を返す
+# 分析用のデータは変数`df`・`st.session_state.df`として参照できる
+# state: 生成したコード内の`st.session_state`の値(分析用のデータ以外)
+def execute(code, df, state):
+    from langchain_experimental.utilities import PythonREPL
+    import matplotlib.pyplot as plt
+    import functions.execution_snapshot as es
+    python_repl = PythonREPL()
+    # dataset_handleで元のデータを変更しないためにはCopy-on-Writeが必要なため、他のモジュールの設定に依存せず実行中は必ず有効にする
+    with pd.option_context('mode.copy_on_write', True):
+        dataset = dataset_handle(df)
+        recorder = es.Recorder(IsolatedSessionState(state, df=dataset))
+        python_repl.globals.update(es.exec_globals(recorder), df=dataset)
+        try:
+            output = python_repl.run(code)
+        finally:
+            # matplotlibの状態はワーカー内で実行をまたいで共有されるため、実行毎に全てのグラフを閉じる
+            # (前の実行のグラフがplt.gcf()で参照されたり、閉じられないまま残り続けたりしないようにする)
+            plt.close('all')
+    # st.stop()で中断した場合は、中断するまでの標準出力を実行結果とする(例外の内容をエラーとして扱わない)
+    if recorder.stopped_output is not None:
+        output = recorder.stopped_output
+    return output, recorder.elements
+
+# 生成したコード内の`st.session_state`(属性・キーのどちらでも参照できるdict)
+# 値を変更しても、streamlitのセッションステートには反映されない
+class IsolatedSessionState(dict):
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+##### ワーカープロセス
+# メモリ使用量の上限を設定する(resourceモジュールが無いWindowsでは設定しない)
+def limit_memory(max_bytes):
+    try:
+        import resource
+    except ImportError:
+        return
+    # RLIMIT_DATAはメモリマップしたファイルを含まないため、共有したデータの大きさに関わらず設定できる
+    resource.setrlimit(resource.RLIMIT_DATA, (max_bytes, max_bytes))
+
+# メモリマップしたArrow形式のファイルからDataFrameを作成する
+def load_dataset(path):
+    with pa.memory_map(str(path)) as source:
+        table = pa.ipc.open_file(source).read_all()
+    # 可能な限りArrowのメモリ(メモリマップ)をそのまま使用し、カラム毎の結合を行わない
+    return table.to_pandas(split_blocks=True)
+
+# ワーカーのメインループ
+# 受信するメッセージ: ('load', データのパス) / ('run', (コード, データのパス, セッションステートの値))
+def worker_main(conn, max_memory):
+    import importlib
+    import matplotlib
+    matplotlib.use('Agg')
+    for module in PRELOAD_MODULES:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass
+    limit_memory(max_memory)
+
+    dataset_path, df = None, None
+    while True:
+        try:
+            kind, payload = conn.recv()
+        except EOFError:
+            break
+        path = payload if kind == 'load' else payload[1]
+        try:
+            if path != dataset_path:
+                # 前のデータを解放してから読み込む
+                dataset_path, df = None, None
+                df = load_dataset(path) if path is not None else None
+                dataset_path = path
+        except Exception as e:
+            # 読み込めないファイル(書き込み途中で中断されたファイルなど)は、streamlit側で削除して書き出し直す
+            conn.send(('load_error', f"Error: 分析用のデータを読み込めませんでした: {e!r}"))
+            continue
+        if kind == 'load':
+            conn.send(('loaded', None))
+            continue
+        try:
+            code, _, state = payload
+            output, elements = execute(code, df, state)
+            conn.send(('result', (output, elements)))
+        except Exception as e:
+            # 実行結果を送信できない場合(pickle化できないオブジェクトを表示する場合など)もエラーとして返す
+            # (例外のクラス名に関わらずエラーと判定されるよう、先頭に"Error"を付ける)
+            conn.send(('error', f"Error: {e!r}"))
+
+# streamlitは実行中のページを__main__として登録するため、ワーカーの起動時に一時的に外す
+# (外さない場合、ワーカーの起動時にページのスクリプトが実行される)
+@contextmanager
+def detached_main():
+    main = sys.modules['__main__']
+    sys.modules['__main__'] = types.ModuleType('__main__')
+    try:
+        yield
+    finally:
+        sys.modules['__main__'] = main
+
+# ワーカープロセスとの通信を行う
+class Worker:
+    def __init__(self, context):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=worker_main, args=(child_conn, WORKER_MAX_MEMORY_BYTES), daemon=True)
+        with detached_main():
+            self.process.start()
+        child_conn.close()
+        self.pending = 0 # 応答を受信していない読み込みの指示の数
+        self.dataset_path = None
+
+    # データを事前に読み込ませる(応答は次の実行時に受信する)
+    def preload(self, path):
+        if path != self.dataset_path:
+            self.conn.send(('load', path))
+            self.pending += 1
+            self.dataset_path = path
+
+    # コードを実行させ、結果を受信する(timeout秒以内に応答が無い場合はTimeoutError)
+    def run(self, code, path, state, timeout):
+        while self.pending:
+            self.conn.recv()
+            self.pending -= 1
+        self.conn.send(('run', (code, path, state)))
+        self.dataset_path = path
+        if not self.conn.poll(timeout):
+            raise TimeoutError(f"コードの実行時間が上限({timeout}秒)を超えたため中断しました")
+        kind, payload = self.conn.recv()
+        if kind == 'load_error':
+            # 壊れたファイルを削除し、次回の実行時に書き出し直す
+            Path(path).unlink(missing_ok=True)
+            self.dataset_path = None
+        if kind != 'result':
+            return payload, []
+        return payload
+
+    def terminate(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+# 待機中のワーカーを管理する(複数のセッションから同時に使用できるよう、実行中のワーカーは待機中のリストから取り出す)
+# データはワーカー毎に1つのみ保持するため、実行時はそのデータを読み込み済みのワーカーを優先して使用し、
+# 事前の読み込みはデータ毎に1つのワーカーのみに行う(他のセッションが読み込ませたデータを置き換えないようにする)
+class WorkerPool:
+    def __init__(self, size):
+        self.context = multiprocessing.get_context('spawn')
+        self.condition = threading.Condition()
+        self.idle = [Worker(self.context) for _ in range(size)] # 待機中のワーカー(最後に使用した日時が古い順)
+        self.workers = list(self.idle) # 実行中のワーカーを含む全てのワーカー
+
+    # 待機中のワーカーを取り出す(データを読み込み済みのワーカー → 最後に使用した日時が最も古いワーカーの順に選ぶ)
+    def acquire(self, path):
+        with self.condition:
+            self.condition.wait_for(lambda: self.idle)
+            worker = next((worker for worker in self.idle if worker.dataset_path == path), self.idle[0])
+            self.idle.remove(worker)
+            return worker
+
+    def release(self, worker):
+        with self.condition:
+            self.idle.append(worker)
+            self.condition.notify()
+
+    # データを事前に読み込ませる(読み込み済み・読み込み中のワーカーがある場合は何もしない)
+    def preload(self, path):
+        with self.condition:
+            if not self.idle or any(worker.dataset_path == path for worker in self.workers):
+                return
+            worker = self.idle.pop(0)
+        try:
+            worker.preload(path)
+        except (OSError, EOFError):
+            worker = self.replace(worker)
+        self.release(worker)
+
+    def run(self, code, path, state, timeout=EXECUTION_TIMEOUT_SECONDS):
+        worker = self.acquire(path)
+        try:
+            return worker.run(code, path, state, timeout)
+        except TimeoutError as e:
+            worker = self.replace(worker)
+            return repr(e), []
+        except (OSError, EOFError):
+            # メモリ不足などによりワーカーが終了している
+            process = worker.process
+            worker = self.replace(worker)
+            return repr(RuntimeError(f"コードの実行中にワーカープロセスが終了しました(終了コード: {process.exitcode})")), []
+        finally:
+            self.release(worker)
+
+    # ワーカーを終了し、新しいワーカーを作成する
+    def replace(self, worker):
+        worker.terminate()
+        new_worker = Worker(self.context)
+        with self.condition:
+            self.workers[self.workers.index(worker)] = new_worker
+        return new_worker
+
+# streamlitのサーバー内で1つのプールを共有する
+@st.cache_resource
+def get_pool():
+    return WorkerPool(WORKER_COUNT)
+
+##### データの共有
+# 分析用のデータをArrow形式のファイルに書き出し、パスを返す(書き出し済みの場合はそのまま返す)
+# Arrow形式に変換できない場合はNone
+def share_dataset():
+    SHARED_DIR.mkdir(parents=True, exist_ok=True)
+    path = SHARED_DIR / f"{hashlib.sha1(dv.version_key().encode()).hexdigest()}.arrow"
+    if path.exists():
+        return path
+    # 書き込み途中のファイルをワーカーが読み込まないよう、一時ファイルに書き込んでから置き換える
+    try:
+        table = arrow_table(st.session_state.df)
+        with af.atomic_path(path) as tmp_path:
+            with pa.OSFile(str(tmp_path), 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+    except (OSError, pa.ArrowException, ValueError, TypeError):
+        return None
+    evict_shared()
+    return path
+
+# 分析用のデータをArrow形式に変換する
+# 数値と文字列などが混在してArrow形式に変換できないカラムは、欠損値以外を文字列に変換する(分析用のデータは変更しない)
+def arrow_table(df):
+    df = df.rename(columns=str)
+    try:
+        return pa.Table.from_pandas(df)
+    except (pa.ArrowException, ValueError, TypeError):
+        pass
+    for col in df.columns[df.dtypes == object]:
+        try:
+            pa.array(df[col], from_pandas=True)
+        except (pa.ArrowException, ValueError, TypeError):
+            df[col] = df[col].map(str, na_action='ignore')
+    return pa.Table.from_pandas(df)
+
+# 保存しているデータの数が上限を超えた場合は古いものから削除する(中断された書き込みの一時ファイルも削除する)
+# (ワーカーが読み込み済みのデータは、ファイルを削除してもメモリマップが有効なまま残る)
+def evict_shared():
+    af.evict_tmp_files(SHARED_DIR)
+    entries = []
+    for path in SHARED_DIR.glob("*.arrow"):
+        try:
+            entries.append((path.stat().st_mtime, path))
+        except FileNotFoundError:
+            continue # 他のセッションが削除済み
+    for _, path in sorted(entries)[:-MAX_SHARED_DATASETS]:
+        path.unlink(missing_ok=True)
+
+# 生成したコード内の`st.session_state`に渡す値(分析用のデータ以外)
+def worker_state():
+    return {name: st.session_state.get(name)
+            for name in ('numeric_columns', 'non_numeric_columns', 'datetime_columns')}
+
+##### 外部から使用する関数
+# ページの表示時に、現在のデータを読み込み済みのワーカーが無ければ、待機中のワーカーの1つに読み込ませる
+def warm_up():
+    if st.session_state.get('df') is None:
+        return
+    path = share_dataset()
+    if path is not None:
+        get_pool().preload(path)
+
+# 生成したコードをワーカーで実行し、標準出力と表示する要素を返す
+# 実行時間・メモリ使用量の上限を設定できず、標準出力・matplotlibの状態が他のセッションと共有されるため、
+# streamlitのプロセス内では実行しない(データをワーカーに渡せない場合はエラーを返す)
+def run(code):
+    path = None
+    if st.session_state.get('df') is not None:
+        path = share_dataset()
+        if path is None:
+            return "Error: 分析用のデータをワーカープロセスに渡せなかったため、コードを実行できませんでした", []
+    return get_pool().run(code, path, worker_state())
@@ -0,0 +1,53 @@
+import streamlit as st
+import pandas as pd
+import functions.data_version as dv
+
+##############################
+#
+# フィルタのウィジェットを作成するための統計量(要素の一覧・最小値・最大値など)をカラム毎に事前に集計しておく
+# 元データの状態(dv.base_key)毎に1度だけ集計し、ウィジェットの操作時にはデータ全体を走査しない
+#
+##############################
+
+# 文字列型のカラムで、要素の一覧を保持するユニーク数の上限(これを超える場合はテキスト入力でフィルタする)
+DISTINCT_LIMIT = 10
+# 文字列型のカラムで、出現頻度の高い要素として保持する数
+TOP_K = 5
+
+# カラム毎の統計量を集計する
+# DataFrameはハッシュ化せず(引数名の先頭に_を付与)、元データの状態を表すキーでキャッシュする
+@st.cache_data(max_entries=16)
+def build_column_stats(_df, key):
+    stats = {}
+    for column in _df.columns:
+        series = _df[column]
+        if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+            # tolist()でnumber_inputが扱えるpythonの数値に変換する
+            min_value, max_value = series.agg(['min', 'max']).tolist()
+            stats[column] = {
+                'kind': 'numeric',
+                'min': min_value,
+                'max': max_value,
+                'quantiles': series.quantile([0.25, 0.5, 0.75]).tolist(),
+            }
+        elif pd.api.types.is_datetime64_any_dtype(series):
+            stats[column] = {
+                'kind': 'datetime',
+                'min': series.min(),
+                'max': series.max(),
+            }
+        else:
+            # 1回の集計でユニーク数・要素の一覧・出現頻度を取得する(並び順は出現順)
+            counts = series.value_counts(dropna=False, sort=False)
+            counts = counts[counts > 0] # カテゴリ型の場合はデータに存在しない要素を除外
+            stats[column] = {
+                'kind': 'category',
+                'n_unique': len(counts),
+                'values': counts.index.tolist() if len(counts) <= DISTINCT_LIMIT else None,
+                'top_values': counts.nlargest(TOP_K).index.tolist(),
+            }
+    return stats
+
+# 現在の元データに対するカラム毎の統計量を取得する
+def get_column_stats():
+    return build_column_stats(st.session_state.df_original, dv.base_key())
@@ -0,0 +1,91 @@
+import os
+import time
+import hashlib
+from pathlib import Path
+import streamlit as st
+import pyarrow as pa
+import pyarrow.parquet as pq
+import functions.func_file_upload as ffu
+import functions.atomic_files as af
+
+##############################
+#
+# アップロードされたデータを、ファイルの中身のハッシュ値をキーとしてParquet形式でディスクにキャッシュする
+# 同じファイルが再度アップロードされた場合(別セッションを含む)は、CSVを再度パースせずにキャッシュを読み込む
+#
+##############################
+
+# キャッシュの保存先(環境変数で変更可能)
+CACHE_DIR = Path(os.environ.get("VIRTUAL_ANALYST_CACHE_DIR", ".cache/datasets"))
+# キャッシュ全体の容量の上限(byte)
+MAX_CACHE_BYTES = int(os.environ.get("VIRTUAL_ANALYST_CACHE_MAX_BYTES", 5 * 1024**3))
+# キャッシュの保持期間(秒)
+MAX_CACHE_AGE_SECONDS = int(os.environ.get("VIRTUAL_ANALYST_CACHE_MAX_AGE", 7 * 24 * 60 * 60))
+
+# アップロードされたファイルの中身からキャッシュのキーを作成
+def file_hash(uploaded_file):
+    # getvalue()はBytesIOの中身をコピーせずに返すため、ファイルサイズ分のメモリを追加で確保しない
+    return hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+
+def cache_path(key):
+    return CACHE_DIR / f"{key}.parquet"
+
+# キャッシュが存在すれば、読み込んだDataFrameを返す(存在しない場合はNone)
+# Parquetは圧縮・エンコードされているため、メモリマップのままでは使用できず、展開したデータをメモリ上に保持する
+# 一定行数ごとに展開してカラム単位でDataFrameに変換し(ffu.tables_to_frame)、展開したデータとDataFrameを同時に保持しない
+# データ型はCSVから読み込んだ場合と揃えるため、Arrowのデータ型(pd.ArrowDtype)は使用しない
+def load_cached(key):
+    path = cache_path(key)
+    if not path.exists():
+        return None
+    try:
+        parquet_file = pq.ParquetFile(path)
+        tables = [pa.Table.from_batches([batch]) for batch in parquet_file.iter_batches(batch_size=ffu.CHUNK_SIZE)]
+        if not tables:
+            # 行が無い場合はカラムのみのDataFrameを作成する
+            tables = [parquet_file.read()]
+    except (OSError, pa.ArrowException):
+        # 壊れたキャッシュは削除して、CSVから読み込み直す
+        path.unlink(missing_ok=True)
+        return None
+    # 最終アクセス日時を更新し、削除の優先度を下げる
+    os.utime(path)
+    return ffu.tables_to_frame(tables)
+
+# DataFrameをキャッシュに書き込み、上限を超えた古いキャッシュを削除する
+def save_cache(key, df):
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    path = cache_path(key)
+    # 書き込み途中のファイルを他のセッションが読み込まないよう、一時ファイルに書き込んでから置き換える
+    try:
+        with af.atomic_path(path) as tmp_path:
+            pq.write_table(pa.Table.from_pandas(df), tmp_path)
+    except (OSError, pa.ArrowException, ValueError, TypeError):
+        # Parquetに変換できない型が含まれる場合はキャッシュしない
+        st.warning("データをキャッシュに保存できなかったため、次回のアップロード時も再度読み込みを行います。", icon=":material/warning:")
+        return
+    evict_cache()
+
+# 保持期間を過ぎたキャッシュと、容量の上限を超えた分のキャッシュを古い順に削除する(中断された書き込みの一時ファイルも削除する)
+def evict_cache(max_bytes=MAX_CACHE_BYTES, max_age=MAX_CACHE_AGE_SECONDS):
+    if not CACHE_DIR.exists():
+        return
+    af.evict_tmp_files(CACHE_DIR)
+    now = time.time()
+    entries = []
+    for path in CACHE_DIR.glob("*.parquet"):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue # 他のセッションが削除済み
+        if now - stat.st_mtime > max_age:
+            path.unlink(missing_ok=True)
+        else:
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        path.unlink(missing_ok=True)
+        total_bytes -= size
@@ -0,0 +1,37 @@
+import streamlit as st
+import pandas as pd
+import functions.data_version as dv
+
+##############################
+#
+# データの概要(データ型・欠損レコード数・冒頭/末尾の行・describeの結果)をデータの状態毎に1度だけ集計する
+# ウィジェットを操作する度に再計算せず、アップロード・フィルタ・型変換によってデータが変わった場合のみ集計し直す
+#
+##############################
+
+# describe関数を実行する(対象のデータ型のカラムが存在しない場合はNone)
+def describe_or_none(df, **kwargs):
+    try:
+        return df.describe(**kwargs)
+    except ValueError:
+        return None
+
+# データの概要を集計する
+# DataFrameはハッシュ化せず(引数名の先頭に_を付与)、データの状態を表すキーでキャッシュする
+@st.cache_data(max_entries=16)
+def build_summary(_df, key):
+    return {
+        'shape': _df.shape,
+        # 型と欠損値
+        'dtypes': pd.concat([_df.dtypes, _df.isnull().sum()], axis=1),
+        'head': _df.head(),
+        'tail': _df.tail(),
+        # 数値型, 日付型の変数のサマリ
+        'describe_numeric': describe_or_none(_df, exclude=["object", "category"]),
+        # 文字列型の変数のサマリ
+        'describe_object': describe_or_none(_df, include=["object", "category"]),
+    }
+
+# 現在の分析用のデータ(st.session_state.df)の概要を取得する
+def get_summary():
+    return build_summary(st.session_state.df, dv.version_key())
@@ -0,0 +1,177 @@
+import hashlib
+import streamlit as st
+import pandas as pd
+
+##############################
+#
+# アップロードしたデータ(st.session_state.df_original)を1つだけ保持し、
+# 分析に使用するデータ(st.session_state.df)は、カラムの選択・行のフィルタを変換手順として記録した上で必要な時に作成する
+# Copy-on-Write(main.pyで有効にする)により、カラムの選択・フィルタのリセット時にデータをコピーせず、元データとメモリを共有する
+#
+##############################
+
+# フィルタ条件ごとに作成したmask(bool型の配列)をキャッシュする容量の上限(byte)
+MASK_CACHE_MAX_BYTES = 64 * 1024**2
+
+##### データの初期化
+# アップロード直後のデータをセッションステートに保存する
+def init_dataset(df, dataset_key):
+    # ページのURLを直接開いてセッションを開始した場合はmain.pyが実行されないため、データを保持する前に有効にする
+    if not pd.get_option("mode.copy_on_write"):
+        pd.set_option("mode.copy_on_write", True)
+    st.session_state.df_original = df # 生データ
+    st.session_state.df = df # 分析に使用するデータ(Copy-on-Writeにより生データとメモリを共有)
+    st.session_state.dataset_key = dataset_key
+    st.session_state.transforms = {
+        'columns': None,     # 使用するカラム(Noneの場合は全カラム)
+        'filters': {},       # カラム名 → フィルタ条件
+        'conversions': [],   # (カラム名, 変換後のデータ型)を変換した順に記録
+        'dropped': [],       # 削除したカラム
+    }
+    st.session_state.filter_masks = {}
+    st.session_state.rollup_cubes = {} # 3変数の集計で使用するロールアップキューブ(functions/rollup_cube.py)
+    st.session_state.df_version = version_key()
+    update_column_types(original=True)
+
+# データ型ごとのカラム名のリストを更新する
+def update_column_types(original=False):
+    df = st.session_state.df
+    # 数値型のカラム名のリスト
+    st.session_state.numeric_columns = df.select_dtypes(include=['number']).columns.tolist()
+    # 日付型のカラム名のリスト(タイムゾーン付きを含む)
+    st.session_state.datetime_columns = df.select_dtypes(include=['datetime', 'datetimetz']).columns.tolist()
+    # 文字列型のカラム名のリスト
+    st.session_state.non_numeric_columns = df.select_dtypes(exclude=['number', 'datetime', 'datetimetz']).columns.tolist()
+    if original:
+        df_original = st.session_state.df_original
+        st.session_state.numeric_columns_original = df_original.select_dtypes(include=['number']).columns.tolist()
+        st.session_state.datetime_columns_original = df_original.select_dtypes(include=['datetime', 'datetimetz']).columns.tolist()
+        st.session_state.non_numeric_columns_original = df_original.select_dtypes(exclude=['number', 'datetime', 'datetimetz']).columns.tolist()
+
+# 元データの状態(アップロードしたファイル + 型変換・カラムの削除)を一意に表すキー
+def base_key():
+    transforms = st.session_state.transforms
+    state = (transforms['conversions'], transforms['dropped'])
+    digest = hashlib.sha1(repr(state).encode()).hexdigest()
+    return f"{st.session_state.dataset_key}:{digest}"
+
+# 分析に使用するデータの状態(元データ + カラムの選択・フィルタ)を一意に表すキー
+# 集計結果などをキャッシュする際に、DataFrame全体をハッシュ化する代わりに使用する
+def version_key():
+    transforms = st.session_state.transforms
+    state = (transforms['columns'], sorted(transforms['filters'].items()))
+    digest = hashlib.sha1(repr(state).encode()).hexdigest()
+    return f"{base_key()}:{digest}"
+
+# DataFrameの状態を一意に表すキー(集計結果・描画結果などをキャッシュする際に使用する)
+# 分析用のデータ(st.session_state.df)はversion_key、それ以外のDataFrame(集計結果など)は内容のハッシュ値を使用する
+def frame_key(df):
+    if df is st.session_state.get('df'):
+        return version_key()
+    digest = hashlib.sha1(pd.util.hash_pandas_object(df).to_numpy().tobytes())
+    digest.update(repr(df.columns.tolist()).encode())
+    return digest.hexdigest()
+
+##### 変換手順の記録
+# 使用するカラムを設定する
+def set_columns(columns):
+    columns = list(columns)
+    if columns == st.session_state.df_original.columns.tolist():
+        columns = None
+    st.session_state.transforms['columns'] = columns
+
+# カラムにフィルタ条件を設定する(specがNoneの場合はフィルタを解除)
+# spec: {'type': 'isin', 'values': [...]} または {'type': 'range', 'min': ..., 'max': ...}
+def set_filter(column, spec):
+    if spec is None:
+        st.session_state.transforms['filters'].pop(column, None)
+    else:
+        st.session_state.transforms['filters'][column] = spec
+
+# カラム選択・フィルタを解除する(元データをそのまま参照するため、コピーは発生しない)
+def reset():
+    st.session_state.transforms['columns'] = None
+    st.session_state.transforms['filters'] = {}
+    refresh()
+
+# 型変換したカラムで元データのカラムを置き換える(変換は元データに対して1度だけ行う)
+# results: カラム名 → (変換後のデータ型, 変換後のSeries)
+def convert_columns(results):
+    # Copy-on-Writeにより、置き換えたカラム以外は変換前のデータとメモリを共有する
+    st.session_state.df_original = st.session_state.df_original.assign(
+        **{column: converted for column, (_, converted) in results.items()}
+    )
+    for column, (new_type, _) in results.items():
+        st.session_state.transforms['conversions'].append((column, new_type))
+        # 型が変わったカラムのフィルタ条件は無効になるため解除する
+        set_filter(column, None)
+    refresh()
+    update_column_types(original=True)
+
+# 元データからカラムを削除する
+def drop_columns(columns):
+    st.session_state.df_original = st.session_state.df_original.drop(columns, axis=1)
+    st.session_state.transforms['dropped'].extend(columns)
+    for column in columns:
+        set_filter(column, None)
+    refresh()
+    update_column_types(original=True)
+
+##### 分析に使用するデータの作成
+# フィルタ条件に一致する行を表すbool型の配列を作成(欠損値は条件に一致しないものとする)
+def filter_mask(series, spec):
+    if spec['type'] == 'isin':
+        mask = series.isin(spec['values'])
+    elif spec['type'] == 'range':
+        mask = (series >= spec['min']) & (series <= spec['max'])
+    else:
+        raise ValueError(f"未対応のフィルタ条件です: {spec['type']}")
+    return mask.to_numpy(dtype=bool, na_value=False)
+
+# カラム毎のmaskをキャッシュから取得する(存在しない場合は作成してキャッシュに追加)
+# 1つのウィジェットを変更した場合は、そのカラムのmaskのみを作り直す
+def column_mask(column, spec):
+    cache = st.session_state.filter_masks
+    key = (base_key(), column, repr(spec))
+    if key in cache:
+        # 最近使用したものとして末尾に移動
+        cache[key] = cache.pop(key)
+        return cache[key]
+
+    mask = filter_mask(st.session_state.df_original[column], spec)
+    cache[key] = mask
+    # 容量の上限を超えた場合は、使用されていない期間が長いものから削除
+    while sum(value.nbytes for value in cache.values()) > MASK_CACHE_MAX_BYTES and len(cache) > 1:
+        cache.pop(next(iter(cache)))
+    return mask
+
+# 全てのフィルタ条件を1つのmaskにまとめる(フィルタ条件が無い場合はNone)
+def combined_mask(filters):
+    mask = None
+    for column, spec in filters.items():
+        if column in st.session_state.df_original.columns:
+            mask = column_mask(column, spec) if mask is None else mask & column_mask(column, spec)
+    return mask
+
+# 記録した変換手順を元データに適用する
+# フィルタ毎に中間のDataFrameを作成せず、まとめたmaskとカラムの選択を1度だけ適用する
+def materialize():
+    df = st.session_state.df_original
+    transforms = st.session_state.transforms
+    columns = transforms['columns']
+    if columns is not None:
+        columns = [col for col in columns if col in df.columns]
+    mask = combined_mask(transforms['filters'])
+
+    if mask is None:
+        return df if columns is None else df[columns]
+    return df.loc[mask] if columns is None else df.loc[mask, columns]
+
+# 変換手順に基づいてst.session_state.dfを作り直す(変換手順に変更が無い場合は作り直さない)
+def refresh():
+    current_version = version_key()
+    if st.session_state.get('df_version') == current_version:
+        return
+    st.session_state.df = materialize()
+    st.session_state.df_version = current_version
+    update_column_types()
@@ -2,31 +2,140 @@ import streamlit as st
 import pandas as pd
 import matplotlib.pyplot as plt
 import io
+from contextlib import contextmanager
+from contextvars import ContextVar
+import pyarrow as pa
+import functions.data_version as dv
+
+# ダウンロード用のファイルをキャッシュする容量の上限(byte)
+DOWNLOAD_CACHE_MAX_BYTES = 128 * 1024**2
+# この要素数(行数×列数)以下のDataFrameは、ボタンが押される前にダウンロード用のファイルを作成しておく
+EAGER_MAX_CELLS = 100_000
+# CSVを作成する際に1度に書き出す行数
+CSV_CHUNK_ROWS = 100_000
+
+# DataFrameのダウンロード形式 → 拡張子・MIMEタイプ・CSVの圧縮方式
+DATAFRAME_FORMATS = {
+    'CSV': {'extension': '.csv', 'mime': 'text/csv', 'compression': None},
+    'CSV(gzip圧縮)': {'extension': '.csv.gz', 'mime': 'application/gzip', 'compression': 'gzip'},
+    'CSV(zstd圧縮)': {'extension': '.csv.zst', 'mime': 'application/zstd', 'compression': 'zstd'},
+    'Parquet': {'extension': '.parquet', 'mime': 'application/vnd.apache.parquet', 'compression': None},
+    'Feather': {'extension': '.feather', 'mime': 'application/vnd.apache.arrow.file', 'compression': None},
+}
+# グラフのダウンロード形式 → 拡張子・MIMEタイプ
+FIGURE_FORMATS = {
+    'PNG': {'extension': '.png', 'mime': 'image/png'},
+    'SVG': {'extension': '.svg', 'mime': 'image/svg+xml'},
+}
+
+# 描画キャッシュ(functions/figure_cache.py)でグラフを作成している間は、ダウンロードボタンを作成せずに引数を記録する
+recorded_downloads = ContextVar('recorded_downloads', default=None)
+
+@contextmanager
+def record_downloads():
+    downloads = []
+    token = recorded_downloads.set(downloads)
+    try:
+        yield downloads
+    finally:
+        recorded_downloads.reset(token)
+
+# index_flag→DataFrameをダウンロードする際に、indexを含めるかどうか
+# svg→描画済みのPNG画像(bytes)をダウンロードする場合に、SVG画像を作成する関数
+def download_file(file, filename, key, index_flag=False, svg=None):
+    downloads = recorded_downloads.get()
+    if downloads is not None and isinstance(file, plt.Figure):
+        downloads.append((filename, key))
+        return
+    download_button(file, filename, key, index_flag, svg)
+
+# DataFrameからダウンロード用のファイルを作成する
+# CSVは1度に書き出す行数を制限し、CSV全体の文字列を作成せずにbytesへ書き出す(圧縮する場合は書き出しながら圧縮する)
+def serialize_dataframe(df, index_flag, file_format):
+    if file_format in ('Parquet', 'Feather'):
+        # Arrow形式はカラム名が文字列である必要があるため変換する
+        df = df.rename(columns=str)
+        buf = io.BytesIO()
+        if file_format == 'Parquet':
+            df.to_parquet(buf, index=index_flag)
+        else:
+            # Featherはindexを保存できないため、index_flagに応じてカラムに変換する
+            df.reset_index(drop=not index_flag).rename(columns=str).to_feather(buf)
+        return buf.getvalue()
+
+    # BytesIOに書き出し、getvalue()で中身をコピーせずにbytesとして取得する(pa.Bufferはbytesへの変換時にコピーが発生する)
+    buf = PayloadBuffer()
+    compression = DATAFRAME_FORMATS[file_format]['compression']
+    stream = buf if compression is None else pa.CompressedOutputStream(pa.PythonFile(buf, mode='w'), compression)
+    for start in range(0, max(len(df), 1), CSV_CHUNK_ROWS):
+        chunk = df.iloc[start:start + CSV_CHUNK_ROWS]
+        stream.write(chunk.to_csv(index=index_flag, header=start == 0).encode())
+    stream.close()
+    return buf.getvalue()
+
+# 閉じた後も中身を取得できるBytesIO(圧縮したストリームを閉じると、書き込み先も閉じられるため)
+class PayloadBuffer(io.BytesIO):
+    def close(self):
+        pass
+
+# ダウンロード用のファイルをキャッシュから取得する(存在しない場合はNone)
+def cached_payload(cache_key):
+    cache = st.session_state.setdefault('download_cache', {})
+    if cache_key in cache:
+        # 最近使用したものとして末尾に移動
+        cache[cache_key] = cache.pop(cache_key)
+        return cache[cache_key]
+    return None
+
+# ダウンロード用のファイルをキャッシュに追加する
+def store_payload(cache_key, payload):
+    cache = st.session_state.setdefault('download_cache', {})
+    cache[cache_key] = payload
+    # 容量の上限を超えた場合は、使用されていない期間が長いものから削除
+    while sum(len(value) for value in cache.values()) > DOWNLOAD_CACHE_MAX_BYTES and len(cache) > 1:
+        cache.pop(next(iter(cache)))
 
-# index_flag→csvファイルをダウンロードする際に使用
 @st.fragment
-def download_file(file, filename, key, index_flag=False):
+def download_button(file, filename, key, index_flag=False, svg=None):
     if isinstance(file, pd.DataFrame):
         # DataFrameの場合
-        csv = file.to_csv(index=index_flag)
+        file_format = st.selectbox("ファイル形式", list(DATAFRAME_FORMATS), key=key+"_format")
+        # 作成したファイルはデータの状態・形式毎にキャッシュし、大きなDataFrameはボタンが押された場合のみ作成する
+        cache_key = (dv.frame_key(file), file_format, index_flag)
+        payload = cached_payload(cache_key)
+        if payload is None:
+            if file.size > EAGER_MAX_CELLS and \
+                not st.button(f":red[**ダウンロード用の{file_format}ファイルを作成**]", key=key+"_prepare"):
+                return
+            try:
+                payload = serialize_dataframe(file, index_flag, file_format)
+            except (pa.ArrowException, ValueError, TypeError):
+                st.error(f"このデータは{file_format}形式に変換できません。CSV形式を選択してください", icon=":material/error:")
+                return
+            store_payload(cache_key, payload)
         st.download_button(
-            label=":red[**データをCSVとしてダウンロード**]",
-            data=csv,
-            file_name=filename+".csv",
-            mime='text/csv',
+            label=f":red[**データを{file_format}としてダウンロード**]",
+            data=payload,
+            file_name=filename+DATAFRAME_FORMATS[file_format]['extension'],
+            mime=DATAFRAME_FORMATS[file_format]['mime'],
             key=key
         )
-    elif isinstance(file, plt.Figure):
-        # Figureの場合
-        buf = io.BytesIO()
-        file.savefig(buf, format='png')
-        buf.seek(0)
+    elif isinstance(file, (plt.Figure, bytes)):
+        # Figure、または描画済みのPNG画像の場合(SVG画像はsvgで作成できる場合のみ選択できる)
+        formats = list(FIGURE_FORMATS) if isinstance(file, plt.Figure) or svg is not None else ['PNG']
+        file_format = st.selectbox("ファイル形式", formats, key=key+"_format") if len(formats) > 1 else 'PNG'
+        if isinstance(file, bytes):
+            payload = file if file_format == 'PNG' else svg()
+        else:
+            buf = io.BytesIO()
+            file.savefig(buf, format=file_format.lower())
+            payload = buf.getvalue()
         st.download_button(
-            label=":red[**グラフをPNG画像としてダウンロード**]",
-            data=buf,
-            file_name=filename+".png",
-            mime='image/png',
+            label=f":red[**グラフを{file_format}画像としてダウンロード**]",
+            data=payload,
+            file_name=filename+FIGURE_FORMATS[file_format]['extension'],
+            mime=FIGURE_FORMATS[file_format]['mime'],
             key=key
         )
     else:
-        st.error("Unsupported file type")
\ No newline at end of file
+        st.error("Unsupported file type")
@@ -1,5 +1,6 @@
 import streamlit as st
 import pandas as pd
+import functions.data_version as dv
 
 ##############################
 #
@@ -28,27 +29,24 @@ def all_null_warning(target_coltype):
         for col in st.session_state.numeric_columns:
             if st.session_state.df[col].isnull().all():
                 st.warning(f"{col} カラムの全ての値がnullになっているため、削除します。", icon=":material/warning:")
-                st.session_state.df = st.session_state.df.drop(col, axis = 1)
-                # filter機能をリセットした際にカラム数に差異が出ないように、df_originalにも処理を実施
-                st.session_state.df_original = st.session_state.df_original.drop(col, axis = 1)
+                # filter機能をリセットした際にカラム数に差異が出ないように、df_originalから削除してdfを作り直す
+                dv.drop_columns([col])
                 output_flag = False
         return output_flag
     if target_coltype == '日付型':
         for col in st.session_state.datetime_columns:
             if st.session_state.df[col].isnull().all():
                 st.warning(f"{col} カラムの全ての値がnullになっているため、削除します。", icon=":material/warning:")
-                st.session_state.df = st.session_state.df.drop(col, axis = 1)
-                # filter機能をリセットした際にカラム数に差異が出ないように、df_originalにも処理を実施
-                st.session_state.df_original = st.session_state.df_original.drop(col, axis = 1)
+                # filter機能をリセットした際にカラム数に差異が出ないように、df_originalから削除してdfを作り直す
+                dv.drop_columns([col])
                 output_flag = False
         return output_flag
     if target_coltype == '文字列型':
         for col in st.session_state.non_numeric_columns:
             if st.session_state.df[col].isnull().all():
                 st.warning(f"{col} カラムの全ての値がnullになっているため、削除します。", icon=":material/warning:")
-                st.session_state.df = st.session_state.df.drop(col, axis = 1)
-                # filter機能をリセットした際にカラム数に差異が出ないように、df_originalにも処理を実施
-                st.session_state.df_original = st.session_state.df_original.drop(col, axis = 1)
+                # filter機能をリセットした際にカラム数に差異が出ないように、df_originalから削除してdfを作り直す
+                dv.drop_columns([col])
                 output_flag = False
         return output_flag
     else:
@@ -0,0 +1,254 @@
+import sys
+import inspect
+import builtins
+import pickle
+import datetime
+import streamlit as st
+import pandas as pd
+import matplotlib.pyplot as plt
+import functions.figure_cache as fc
+
+##############################
+#
+# Chatbotで生成したコードの実行結果のスナップショット
+# 生成したコードの実行時は、streamlitの代わりに呼び出しを記録するオブジェクト(Recorder)をimportさせ、
+# 表示する要素(テキスト・DataFrame・グラフなど)を呼び出した順に記録する(グラフはPNG画像(bytes)に変換する)
+# 過去の実行履歴は記録した要素を再表示するだけとし、コードの再実行はユーザーが指示した場合のみ行う
+#
+##############################
+
+# 子要素を持つ要素(戻り値をwith文・要素の追加先として使用する)
+CONTAINER_ELEMENTS = {'container', 'expander', 'popover', 'form', 'empty', 'chat_message', 'status'}
+# 子要素のリストを返す要素
+MULTI_CONTAINER_ELEMENTS = {'columns', 'tabs'}
+# 表示には影響しないため、記録せずに何もしない要素(with文で使用した場合は、現在の追加先にそのまま追加する)
+IGNORED_ELEMENTS = {'spinner', 'set_page_config', 'rerun', 'echo', 'toast', 'balloons', 'snow'}
+# 戻り値を更新して使用する要素(最初の呼び出しのみ記録し、戻り値に対する呼び出しは記録しない)
+DETACHED_ELEMENTS = {'progress'}
+# 子要素を追加できる属性(st.sidebar.write(...)など。表示時は呼び出した位置に表示する)
+NAMESPACE_ELEMENTS = {'sidebar'}
+# 関数をそのまま返すデコレーター(キャッシュは実行毎に作り直すため不要)
+DECORATORS = {'cache_data', 'cache_resource', 'fragment', 'experimental_memo', 'experimental_singleton'}
+# streamlitのモジュールをそのまま使用する属性
+PASSTHROUGH_ATTRIBUTES = {'column_config'}
+# 記録する表(DataFrame・Series)の最大行数(超えた場合は先頭の行のみ記録し、分析用のデータ全体を実行履歴に保持しない)
+MAX_RECORDED_ROWS = 1000
+# 実行履歴に保持するスナップショットの容量の上限(byte, 超えた場合は古い実行結果のスナップショットから削除する)
+HISTORY_MAX_BYTES = 64 * 1024**2
+
+##### 実行結果の記録
+# streamlitの関数の呼び出しを記録する
+# elements: 記録した要素のリスト
+#   {'type': 'element', 'name': 関数名, 'args': 引数, 'kwargs': キーワード引数}
+#   {'type': 'figure', 'png': PNG画像}
+#   {'type': 'container', 'name': 関数名, 'args': 引数, 'kwargs': キーワード引数, 'children': 子要素のリスト(複数の場合はリストのリスト)}
+class Recorder:
+    # root: 最上位のRecorder(生成したコード内の`st`)
+    def __init__(self, session_state=None, root=None):
+        self.elements = []
+        self.session_state = session_state if session_state is not None else st.session_state
+        self.root = root if root is not None else self
+        self.stack = [] # with文で指定中の要素の追加先(最上位のRecorderのみ使用する)
+        self.stopped_output = None # st.stop()で中断した場合の、中断するまでの標準出力(最上位のRecorderのみ使用する)
+
+    # with文の中で`st`の関数を呼び出した場合は、with文で指定した要素に追加する(streamlitと同じ動作)
+    def __enter__(self):
+        self.root.stack.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.root.stack.pop()
+        return False
+
+    # 要素の追加先(with文で指定中の要素があればその要素)
+    def target(self):
+        return self.stack[-1] if self is self.root and self.stack else self
+
+    def append(self, element):
+        self.target().elements.append(element)
+
+    # 表示する要素を記録する(大きな表は先頭の行のみ記録し、記録した行数を注記する)
+    def record_element(self, name, args, kwargs):
+        args = tuple(preview_value(value) for value in args)
+        kwargs = {key: preview_value(value) for key, value in kwargs.items()}
+        self.append({'type': 'element', 'name': name, 'args': args, 'kwargs': kwargs})
+        total_rows = max([truncated_rows(value) for value in [*args, *kwargs.values()]], default=0)
+        if total_rows:
+            self.append({'type': 'element', 'name': 'caption',
+                         'args': (f"実行履歴には先頭の{MAX_RECORDED_ROWS}行のみ記録しています(全{total_rows}行)",), 'kwargs': {}})
+
+    def child(self):
+        return Recorder(self.session_state, self.root)
+
+    # 記録したグラフは閉じる(同じグラフがplt.gcf()などで再度描画されないようにする)
+    def pyplot(self, fig=None, *args, **kwargs):
+        if not isinstance(fig, plt.Figure):
+            fig = plt.gcf()
+        self.append({'type': 'figure', 'png': fc.savefig_bytes(fig, 'png')})
+        plt.close(fig)
+
+    def write(self, *args, **kwargs):
+        if len(args) == 1 and isinstance(args[0], plt.Figure):
+            return self.pyplot(args[0])
+        self.record_element('write', args, kwargs)
+
+    # 実行を中断する(st.stop()と同じく、それまでの出力・表示は実行結果として残す)
+    def stop(self):
+        # PythonREPLは例外の内容を出力として返すため、中断するまでの標準出力を保持しておく
+        self.root.stopped_output = getattr(sys.stdout, 'getvalue', str)()
+        raise StopExecution()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name in PASSTHROUGH_ATTRIBUTES:
+            return getattr(st, name)
+        if name in NAMESPACE_ELEMENTS:
+            child = self.child()
+            self.append({'type': 'container', 'name': 'container', 'args': (), 'kwargs': {}, 'children': child.elements})
+            return child
+        if name in DECORATORS:
+            return identity_decorator
+        if name in INPUT_WIDGETS:
+            return lambda *args, **kwargs: widget_value(name, args, kwargs)
+
+        def record(*args, **kwargs):
+            if name in IGNORED_ELEMENTS:
+                return self.target()
+            if name in DETACHED_ELEMENTS:
+                self.record_element(name, args, kwargs)
+                return self.child()
+            if name == 'data_editor':
+                # 編集はできないため、表として記録して入力したデータをそのまま返す
+                data = args[0] if args else kwargs.get('data')
+                self.record_element('dataframe', (data,), {})
+                return data
+            if name in CONTAINER_ELEMENTS:
+                child = self.child()
+                self.append({'type': 'container', 'name': name, 'args': args, 'kwargs': kwargs,
+                             'children': child.elements})
+                return child
+            if name in MULTI_CONTAINER_ELEMENTS:
+                spec = args[0] if args else kwargs.get('spec', kwargs.get('tabs'))
+                count = spec if isinstance(spec, int) else len(spec)
+                children = [self.child() for _ in range(count)]
+                self.append({'type': 'container', 'name': name, 'args': args, 'kwargs': kwargs,
+                             'children': [child.elements for child in children]})
+                return children
+            self.record_element(name, args, kwargs)
+        return record
+
+# 表(DataFrame・Series)が最大行数を超える場合は先頭の行のみ返す
+# (先頭の行を別のオブジェクトとして持つため、元の表はスナップショットから参照されない)
+def preview_value(value):
+    if isinstance(value, (pd.DataFrame, pd.Series)) and len(value) > MAX_RECORDED_ROWS:
+        preview = value.head(MAX_RECORDED_ROWS).copy()
+        preview.attrs['recorded_total_rows'] = len(value)
+        return preview
+    return value
+
+# 先頭の行のみ記録した表の元の行数(それ以外は0)
+def truncated_rows(value):
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return value.attrs.get('recorded_total_rows', 0)
+    return 0
+
+# st.stop()で実行を中断した場合の例外
+class StopExecution(Exception):
+    pass
+
+# @st.cache_data・@st.cache_data(ttl=...)のどちらの形式でも、関数をそのまま返す
+def identity_decorator(func=None, *args, **kwargs):
+    if callable(func):
+        return func
+    return lambda func: func
+
+##### 入力ウィジェット
+# 入力ウィジェットは記録せず(実行結果の表示時には操作できないため)、初期値を返す
+# 値: 引数(省略した場合はstreamlitの関数の既定値)から初期値を求める関数
+INPUT_WIDGETS = {
+    'selectbox': lambda a: option_at(a['options'], a['index']),
+    'radio': lambda a: option_at(a['options'], a['index']),
+    'multiselect': lambda a: default_list(a['default']),
+    'pills': lambda a: default_list(a['default']) if a['selection_mode'] == 'multi' else a['default'],
+    'segmented_control': lambda a: default_list(a['default']) if a['selection_mode'] == 'multi' else a['default'],
+    'select_slider': lambda a: a['value'] if a['value'] is not None else option_at(a['options'], 0),
+    'slider': lambda a: next((value for value in (a['value'], a['min_value']) if value is not None), 0),
+    'number_input': lambda a: (a['min_value'] if a['min_value'] is not None else 0.0) if a['value'] == 'min' else a['value'],
+    'checkbox': lambda a: a['value'],
+    'toggle': lambda a: a['value'],
+    'text_input': lambda a: a['value'],
+    'text_area': lambda a: a['value'],
+    'color_picker': lambda a: a['value'] if a['value'] is not None else '#000000',
+    'date_input': lambda a: datetime.date.today() if a['value'] == 'today' else a['value'],
+    'time_input': lambda a: datetime.datetime.now().time().replace(second=0, microsecond=0) if a['value'] == 'now' else a['value'],
+    'button': lambda a: False,
+    'form_submit_button': lambda a: False,
+    'download_button': lambda a: False,
+    'link_button': lambda a: False,
+    'page_link': lambda a: None,
+    'file_uploader': lambda a: None,
+    'camera_input': lambda a: None,
+    'audio_input': lambda a: None,
+    'chat_input': lambda a: None,
+    'feedback': lambda a: None,
+}
+
+def option_at(options, index):
+    options = list(options)
+    return options[index] if index is not None and options else None
+
+def default_list(default):
+    if default is None:
+        return []
+    if isinstance(default, (list, tuple, set)):
+        return list(default)
+    return [default]
+
+# 入力ウィジェットの初期値(引数はstreamlitの関数の引数として解釈する)
+def widget_value(name, args, kwargs):
+    arguments = inspect.signature(getattr(st, name)).bind_partial(*args, **kwargs)
+    arguments.apply_defaults()
+    return INPUT_WIDGETS[name](arguments.arguments)
+
+# 生成したコードを実行する際のグローバル変数(streamlitをimportした場合はrecorderを返す)
+def exec_globals(recorder):
+    def import_module(name, *args, **kwargs):
+        if name == 'streamlit':
+            return recorder
+        return builtins.__import__(name, *args, **kwargs)
+    return {'__builtins__': {**vars(builtins), '__import__': import_module}}
+
+##### 実行履歴の容量
+# スナップショットの容量(byte, ワーカーから受信した際と同じくpickle化した大きさ)
+def snapshot_bytes(elements):
+    return len(pickle.dumps(elements, protocol=pickle.HIGHEST_PROTOCOL))
+
+# 実行履歴のスナップショットの合計が上限を超えた場合は、古い実行結果のスナップショットから削除する
+# (プロンプト・コード・標準出力は残し、削除したものは再実行で表示し直す)
+# keep: 削除しない実行結果(再実行した実行結果)
+def trim_history(executions, keep=None, max_bytes=HISTORY_MAX_BYTES):
+    total_bytes = keep.get('bytes', 0) if keep is not None else 0
+    for execution in reversed(executions):
+        if execution is keep:
+            continue
+        total_bytes += execution.get('bytes', 0)
+        if total_bytes > max_bytes and execution['elements']:
+            execution.update(elements=[], bytes=0, trimmed=True)
+
+##### 実行結果の表示
+# 記録した要素を呼び出した順に表示する
+# target: 表示先(st・st.expanderの戻り値など)
+def render(elements, target=st):
+    for element in elements:
+        if element['type'] == 'figure':
+            target.image(element['png'], use_container_width=True)
+        elif element['type'] == 'container':
+            container = getattr(target, element['name'])(*element['args'], **element['kwargs'])
+            if element['name'] in MULTI_CONTAINER_ELEMENTS:
+                for child_target, children in zip(container, element['children']):
+                    render(children, child_target)
+            else:
+                render(element['children'], container)
+        else:
+            getattr(target, element['name'])(*element['args'], **element['kwargs'])
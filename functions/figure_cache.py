@@ -0,0 +1,96 @@
+import io
+import streamlit as st
+import pandas as pd
+import matplotlib.pyplot as plt
+import functions.data_version as dv
+import functions.download_files as download_files
+
+##############################
+#
+# グラフの描画キャッシュ
+# 描画したグラフをPNG画像(bytes)に変換し、(データの状態, 関数, 引数)毎に保持する(SVG画像はダウンロード時に作成して保持する)
+# SVG画像の作成用に引数(DataFrame)を保持するため、データの状態が変わった時点で古いグラフは削除し、
+# 分析用のデータ(st.session_state.df)以外のDataFrameは容量に含める
+# 同じ条件のグラフを再表示する場合は、matplotlibを使用せずに保持したPNG画像を表示する
+# 作成したFigureはPNG画像に変換した時点で閉じる(Figureが残り続けてメモリを消費しないようにする)
+#
+##############################
+
+# 描画済みのPNG画像をキャッシュする容量の上限(byte)
+FIGURE_CACHE_MAX_BYTES = 64 * 1024**2
+# PNG画像の解像度(st.pyplotと同じ)
+FIGURE_DPI = 200
+
+##### キャッシュのキー
+# 引数をキャッシュのキーに変換する(DataFrameはdv.frame_keyを使用する)
+def arg_token(value):
+    if isinstance(value, pd.DataFrame):
+        return ('frame', dv.frame_key(value))
+    return repr(value)
+
+# (データの状態, 関数, 引数)からキャッシュのキーを作成する(ハッシュ化できない引数を含む場合はNone)
+def figure_key(func, args, kwargs):
+    try:
+        tokens = [arg_token(value) for value in args] + [(name, arg_token(value)) for name, value in sorted(kwargs.items())]
+    except TypeError:
+        return None
+    return (dv.version_key(), func.__name__, repr(tokens))
+
+##### 描画
+# グラフを作成してPNG画像に変換する
+# 関数内で作成されるダウンロードボタンは作成せずに引数を記録し、PNG画像と合わせて保持する
+# SVG画像はダウンロード時に選択された場合のみ、グラフを作成し直して作成する
+def draw(func, args, kwargs):
+    with download_files.record_downloads() as downloads:
+        fig = func(*args, **kwargs)
+    return {'png': savefig_bytes(fig, 'png'), 'svg': None, 'downloads': downloads,
+            'redraw': lambda: func(*args, **kwargs), 'pinned_bytes': pinned_bytes(args, kwargs)}
+
+# SVG画像の作成用に保持する引数のうち、分析用のデータ以外のDataFrame(集計結果など)の容量(byte)
+def pinned_bytes(args, kwargs):
+    df = st.session_state.get('df')
+    return sum(int(value.memory_usage(deep=True).sum()) for value in [*args, *kwargs.values()]
+               if isinstance(value, pd.DataFrame) and value is not df)
+
+# Figureを画像に変換して閉じる
+def savefig_bytes(fig, file_format):
+    buf = io.BytesIO()
+    fig.savefig(buf, format=file_format, dpi=FIGURE_DPI, bbox_inches='tight')
+    plt.close(fig)
+    return buf.getvalue()
+
+# SVG画像を取得する(作成済みでない場合はグラフを作成し直す)
+def svg_bytes(entry):
+    if entry['svg'] is None:
+        with download_files.record_downloads():
+            fig = entry['redraw']()
+        entry['svg'] = savefig_bytes(fig, 'svg')
+    return entry['svg']
+
+# キャッシュしている画像と、保持している引数の容量(byte)
+def entry_bytes(entry):
+    return len(entry['png']) + len(entry['svg'] or b'') + entry['pinned_bytes']
+
+# func(*args, **kwargs)で作成したグラフを表示する(キャッシュに存在する場合は保持したPNG画像を表示する)
+def render(func, *args, **kwargs):
+    key = figure_key(func, args, kwargs)
+    cache = st.session_state.setdefault('figure_cache', {})
+    # データの状態が変わった場合は、変更前のデータを保持し続けないよう古いグラフを削除
+    version = dv.version_key()
+    for stale_key in [cached_key for cached_key in cache if cached_key[0] != version]:
+        del cache[stale_key]
+    if key in cache:
+        # 最近使用したものとして末尾に移動
+        cache[key] = cache.pop(key)
+        entry = cache[key]
+    else:
+        entry = draw(func, args, kwargs)
+        if key is not None:
+            cache[key] = entry
+            # 容量の上限を超えた場合は、使用されていない期間が長いものから削除
+            while sum(entry_bytes(value) for value in cache.values()) > FIGURE_CACHE_MAX_BYTES and len(cache) > 1:
+                cache.pop(next(iter(cache)))
+
+    for filename, download_key in entry['downloads']:
+        download_files.download_file(entry['png'], filename, download_key, svg=lambda: svg_bytes(entry))
+    st.image(entry['png'], use_container_width=True)
@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+
+##############################
+#
+# 基礎集計の各関数で共通して使用する集計処理
+#
+##############################
+
+# 画面上の集計方法の名称 → pandasの集計関数
+AGG_FUNCS = {
+    'カウント': 'count',
+    '合計': 'sum',
+    '平均': 'mean',
+    '中央値': 'median',
+    '最大値': 'max',
+    '最小値': 'min',
+}
+# レコード数の割合が閾値以下の要素をまとめる際のカテゴリ名
+OTHER_LABEL = 'その他'
+
+##### 必要なカラムへの絞り込み
+# 集計に使用するカラムのみを持つDataFrameを作成する(同じカラムを複数回指定した場合は1つにまとめる)
+# 入力のDataFrame全体はコピーせず、後続の処理でカラムを書き換えた場合も入力側には影響しない(Copy-on-Write)
+def project(df, columns):
+    return df[list(dict.fromkeys(columns))]
+
+##### グループ別の集計
+# 1回のgroupbyで複数の統計量をまとめて算出する(グループ分けは1度だけ行う)
+# aggs: 出力するカラム名 → pandasの集計関数
+def grouped_agg(df, keys, col_numeric, aggs):
+    agg_df = df.groupby(keys, observed=True)[col_numeric].agg(list(aggs.values()))
+    agg_df.columns = list(aggs.keys())
+    return agg_df.reset_index()
+
+##### 「その他」へのカテゴリの丸め
+# 要素毎のレコード数を数え、割合が閾値以下の要素を「その他」にまとめる
+# 整数のコードに変換した上で集計するため、要素毎・行毎のpythonのループは発生しない
+# weights: 各行が表すレコード数(集計済みのデータの場合に指定する。Noneの場合は1行を1レコードとして数える)
+# 戻り値: (度数分布表, 丸めたカテゴリを各行に割り当てたカテゴリ型のSeries)
+def bucket_categories(series, threshold, weights=None):
+    # 要素を整数のコードに変換(欠損値は-1)し、コード毎のレコード数を数える
+    codes, uniques = pd.factorize(series)
+    valid = codes >= 0
+    if weights is None:
+        counts = np.bincount(codes[valid], minlength=len(uniques))
+    else:
+        counts = np.bincount(codes[valid], weights=np.asarray(weights)[valid], minlength=len(uniques)).astype(np.int64)
+    ratio = counts / max(counts.sum(), 1)
+
+    # 要素毎に丸めた後のカテゴリ名を決める
+    labels = pd.Series(np.asarray(uniques, dtype=object), dtype=object).where(ratio > threshold, OTHER_LABEL)
+    # 度数分布表はレコード数の降順に並べる(同数の場合は出現順)
+    order = np.argsort(-counts, kind='stable')
+    table = pd.DataFrame({
+        series.name: uniques.take(order),
+        'レコード数': counts[order],
+        '割合': ratio[order],
+        'カテゴリ': labels.to_numpy()[order],
+    })
+
+    # 丸めたカテゴリのコードを各行に割り当てる(カテゴリの並び順は可能であれば昇順)
+    bucket_codes, bucket_labels = pd.factorize(labels)
+    try:
+        sorted_labels = bucket_labels.sort_values()
+        bucket_codes = sorted_labels.get_indexer(bucket_labels)[bucket_codes]
+        bucket_labels = sorted_labels
+    except TypeError:
+        pass # 文字列と数値が混在している場合などは並べ替えない
+    row_codes = np.full(len(codes), -1, dtype=np.intp)
+    row_codes[valid] = bucket_codes[codes[valid]]
+    bucketed = pd.Series(pd.Categorical.from_codes(row_codes, categories=bucket_labels),
+                         index=series.index, name='カテゴリ')
+    return table, bucketed
+
+##### クロス集計
+# 2つのカテゴリ型のSeriesについて、組み合わせ毎のレコード数をカテゴリのコードから直接数える
+# 縦持ちへの変換・ピボットを経由せず、行: rowのカテゴリ × 列: columnのカテゴリの表を返す
+# (いずれかが欠損値の行は数えず、レコードが存在しないカテゴリの行・列は除外する)
+def crosstab_codes(row, column):
+    row_codes = row.cat.codes.to_numpy().astype(np.int64)
+    column_codes = column.cat.codes.to_numpy().astype(np.int64)
+    valid = (row_codes >= 0) & (column_codes >= 0)
+    n_rows, n_columns = len(row.cat.categories), len(column.cat.categories)
+
+    # (行のコード, 列のコード)の組み合わせを1つの整数にまとめて数える
+    counts = np.bincount(row_codes[valid] * n_columns + column_codes[valid],
+                         minlength=n_rows * n_columns).reshape(n_rows, n_columns)
+    keep_rows = counts.sum(axis=1) > 0
+    keep_columns = counts.sum(axis=0) > 0
+    return pd.DataFrame(counts[keep_rows][:, keep_columns],
+                        index=pd.Index(row.cat.categories[keep_rows], name=row.name),
+                        columns=pd.Index(column.cat.categories[keep_columns], name=column.name))
@@ -4,13 +4,23 @@ import seaborn as sns
 import matplotlib.pyplot as plt
 import japanize_matplotlib
 import functions.download_files as download_files
+import functions.func_aggregation as fag
+import functions.time_buckets as tb
+import functions.rollup_cube as rc
+import functions.quantile_sketch as qs
+import functions.large_plots as lp
 from datetime import datetime
 
 ##### 1変数の分布の可視化
 # 数値型のヒストグラム
-def histogram(df, colname):
+# 行数がdownsample_thresholdを超える場合は、ビン毎に集計したレコード数と近似したKDEを描画する
+def histogram(df, colname, downsample_threshold=None):
     fig, ax = plt.subplots()
-    sns.histplot(df[colname], kde=True, ax=ax)
+    if downsample_threshold is None or len(df) <= downsample_threshold:
+        sns.histplot(df[colname], kde=True, ax=ax)
+    else:
+        lp.plot_binned_histogram(ax, df[colname])
+        lp.add_note(ax, f'{len(df):,}行のため、ビン毎に集計して描画(KDEは近似)')
     ax.set_title(f'ヒストグラム: {colname}')
     ax.set_xlabel(colname)
     ax.set_ylabel('頻度')
@@ -20,16 +30,9 @@ def histogram(df, colname):
 
 # 文字列型の度数分布表
 def colname_counts(df, colname, download_flag=False, threshold=0.05):
-    # 項目ごとに要素の数を数える
-    counts = df[colname].value_counts().reset_index()
-    counts.columns = [colname, 'レコード数']
-    
-    # レコード数の全体に対する割合を計算
-    counts['割合'] = counts['レコード数'] / counts['レコード数'].sum()
-    # レコード数を降順に並べ替え
-    counts = counts.sort_values(by='レコード数', ascending=False).reset_index(drop=True)
-    # 割合が閾値以下の場合に「その他」というカテゴリを与える
-    counts['カテゴリ'] = counts.apply(lambda row: 'その他' if row['割合'] <= threshold else row[colname], axis=1)
+    # 項目ごとに要素の数を数えて割合を計算し、割合が閾値以下の場合に「その他」というカテゴリを与える
+    # (レコード数の降順に並べ替え済み)
+    counts, _ = fag.bucket_categories(df[colname], threshold)
     
     # ファイルダウンロードを行うかどうか判定
     # 別の描画関数の内部で呼び出されることがあるため、flagによる分岐を設定
@@ -43,8 +46,9 @@ def colname_counts(df, colname, download_flag=False, threshold=0.05):
 
 ##### 2変数の分布の可視化
 # 相関行列のヒートマップ
-def plot_correlation_heatmap(df):
-    corr = df.corr()
+# columnsを指定した場合は、指定したカラムのみの相関行列を描画する
+def plot_correlation_heatmap(df, columns=None):
+    corr = (df if columns is None else df[columns]).corr()
     fig, ax = plt.subplots()
     sns.heatmap(corr, annot=True, fmt=".2f", cmap="coolwarm", ax=ax)
     ax.set_title('相関行列のヒートマップ')
@@ -53,9 +57,14 @@ def plot_correlation_heatmap(df):
     return fig
 
 # 数値型×数値型
-def plot_scatter(df, col1, col2):
+# 行数がdownsample_thresholdを超える場合は、六角形のビン毎のレコード数を描画する
+def plot_scatter(df, col1, col2, downsample_threshold=None):
     fig, ax = plt.subplots()
-    sns.scatterplot(x=df[col1], y=df[col2], ax=ax)
+    if downsample_threshold is None or len(df) <= downsample_threshold:
+        sns.scatterplot(x=df[col1], y=df[col2], ax=ax)
+    else:
+        lp.plot_hexbin(ax, df[col1], df[col2])
+        lp.add_note(ax, f'{len(df):,}行のため、ビン毎のレコード数を描画')
     ax.set_title(f'{col1}と{col2}の散布図')
     ax.set_xlabel(col1)
     ax.set_ylabel(col2)
@@ -64,14 +73,25 @@ def plot_scatter(df, col1, col2):
     return fig
 
 # 数値型×文字列型
-def plot_box(df, col1, col2, threshold):
-    # 数値型の度数分布を集計しておく
-    value_counts = colname_counts(df, col1, False, threshold)
-    # 度数分布の割合を基に算出したカテゴリをleft join
-    df = pd.merge(df, value_counts[[col1, 'カテゴリ']], on=col1, how="left")
-
+# relative_accuracyを指定した場合は、四分位数をスケッチから近似計算して描画する(外れ値は描画しない)
+def plot_box(df, col1, col2, threshold, relative_accuracy=None):
     fig, ax = plt.subplots()
-    sns.boxplot(x=df["カテゴリ"], y=df[col2], ax=ax)
+    if relative_accuracy is None:
+        # 度数分布の割合を基に算出したカテゴリを各行に割り当てる
+        _, category = fag.bucket_categories(df[col1], threshold)
+        sns.boxplot(x=category, y=df[col2], ax=ax)
+    else:
+        # 要素・バケット毎のレコード数を集計したスケッチに対して、度数分布の割合を基に算出したカテゴリを割り当てる
+        sketch = rc.get_sketch(df, [col1], col2, relative_accuracy)
+        _, category = fag.bucket_categories(sketch[col1], threshold, sketch[qs.COUNT_LABEL])
+        stats = qs.sketch_quantile(sketch, [category], [0, 0.25, 0.5, 0.75, 1])
+        # ひげは四分位範囲の1.5倍までの範囲とする
+        iqr = stats[0.75] - stats[0.25]
+        ax.bxp([{'label': label, 'q1': row[0.25], 'med': row[0.5], 'q3': row[0.75],
+                 'whislo': max(row[0], row[0.25] - 1.5 * iqr[label]),
+                 'whishi': min(row[1], row[0.75] + 1.5 * iqr[label]), 'fliers': []}
+                for label, row in stats.iterrows()], showfliers=False)
+        ax.set_title(f'四分位数は近似値(相対誤差{relative_accuracy:.1%}以内)', fontsize=9)
     #ax.set_title(f'{col1}に対する{col2}の箱ひげ図')
     ax.set_xlabel(col1)
     ax.set_ylabel(col2)
@@ -81,29 +101,33 @@ def plot_box(df, col1, col2, threshold):
     return fig
 
 # 1つの文字列型ごとに数値の集計を行う
-def agg_1parameter(df, col1, col2, threshold):
-    # 数値型の度数分布を集計しておく
-    value_counts = colname_counts(df, col1, False, threshold)
-    # 度数分布の割合を基に算出したカテゴリをleft join
-    df = pd.merge(df, value_counts[[col1, 'カテゴリ']], on=col1, how="left")
-
-    # 指定された集計を実施
-    agg_data_list = [] # 変数の初期化
-    agg_data = df[['カテゴリ']].drop_duplicates()
-    # 集計値をリストに追加
-    agg_data_list.append(df.groupby(['カテゴリ'])[col2].count().reset_index().rename(columns={col2:'レコード数'}))
-    agg_data_list.append(df.groupby(['カテゴリ'])[col2].sum().reset_index().rename(columns={col2:'合計'}))
-    agg_data_list.append(df.groupby(['カテゴリ'])[col2].mean().reset_index().rename(columns={col2:'平均値'}))
-    agg_data_list.append(df.groupby(['カテゴリ'])[col2].median().reset_index().rename(columns={col2:'中央値'}))
-    agg_data_list.append(df.groupby(['カテゴリ'])[col2].max().reset_index().rename(columns={col2:'最大値'}))
-    agg_data_list.append(df.groupby(['カテゴリ'])[col2].min().reset_index().rename(columns={col2:'最小値'}))
-    # 集計値を１つのテーブルに集約
-    for df_tmp in agg_data_list:
-        agg_data = pd.merge(agg_data, df_tmp, on='カテゴリ', how='left')
+# relative_accuracyを指定した場合は、中央値をスケッチから近似計算する
+def agg_1parameter(df, col1, col2, threshold, relative_accuracy=None):
+    # 度数分布の割合を基に算出したカテゴリを各行に割り当てる
+    _, category = fag.bucket_categories(df[col1], threshold)
+    df_agg = pd.DataFrame({'カテゴリ': category, col2: df[col2]})
+
+    # 指定された集計を1回のgroupbyでまとめて実施
+    aggs = {
+        'レコード数': 'count',
+        '合計': 'sum',
+        '平均値': 'mean',
+        '中央値': 'median',
+        '最大値': 'max',
+        '最小値': 'min',
+    }
+    if relative_accuracy is None:
+        agg_data = fag.grouped_agg(df_agg, ['カテゴリ'], col2, aggs)
+    else:
+        # 中央値以外を集計した上で、スケッチから算出した中央値を元の位置に追加する
+        agg_data = fag.grouped_agg(df_agg, ['カテゴリ'], col2, {name: func for name, func in aggs.items() if func != 'median'})
+        sketch = rc.get_sketch(df, [col1], col2, relative_accuracy)
+        _, sketch_category = fag.bucket_categories(sketch[col1], threshold, sketch[qs.COUNT_LABEL])
+        median = qs.sketch_quantile(sketch, [sketch_category], 0.5)
+        agg_data.insert(list(aggs).index('中央値') + 1, '中央値', agg_data['カテゴリ'].map(median).astype(float))
 
     # 元のカラム名に戻してソートする
     agg_data = agg_data.rename(columns = {'カテゴリ': col1})
-    agg_data = agg_data[~agg_data[col1].isnull()]
     agg_data = agg_data.sort_values(by='レコード数', ascending=False)
 
     # ファイルダウンロード
@@ -112,59 +136,17 @@ def agg_1parameter(df, col1, col2, threshold):
     return agg_data
 
 # 時系列の変数を用いて数値を集計する
-def agg_datetime_dataframe(df_input, datetime_type, agg_type, col_datetime, col_numeric):
-    df = df_input[[col_datetime, col_numeric]].copy() # 必要カラムのみに絞りこみ
-    df.set_index(col_datetime, inplace=True)
-
+def agg_datetime_dataframe(df_input, datetime_type, agg_type, col_datetime, col_numeric, relative_accuracy=None):
     # datetime_typeに応じて日付カラムの粒度を変更し、agg_typeに基づいて集計
-    if datetime_type == '月':
-        if agg_type == '合計':
-            agg_df = df.resample('M').sum()
-        elif agg_type == '平均':
-            agg_df = df.resample('M').mean()
-        elif agg_type == '中央値':
-            agg_df = df.resample('M').median()
-        elif agg_type == 'カウント':
-            agg_df = df.resample('M').count()
-    elif datetime_type == '週':
-        if agg_type == '合計':
-            agg_df = df.resample('W').sum()
-        elif agg_type == '平均':
-            agg_df = df.resample('W').mean()
-        elif agg_type == '中央値':
-            agg_df = df.resample('W').median()
-        elif agg_type == 'カウント':
-            agg_df = df.resample('W').count()
-    elif datetime_type == '日':
-        if agg_type == '合計':
-            agg_df = df.resample('D').sum()
-        elif agg_type == '平均':
-            agg_df = df.resample('D').mean()
-        elif agg_type == '中央値':
-            agg_df = df.resample('D').median()
-        elif agg_type == 'カウント':
-            agg_df = df.resample('D').count()
-    elif datetime_type == '時間':
-        if agg_type == '合計':
-            agg_df = df.resample('H').sum()
-        elif agg_type == '平均':
-            agg_df = df.resample('H').mean()
-        elif agg_type == '中央値':
-            agg_df = df.resample('H').median()
-        elif agg_type == 'カウント':
-            agg_df = df.resample('H').count()
-
-    return agg_df.reset_index().sort_values(by=col_datetime, ascending=True)
+    # (合計・平均・カウントは時間単位の集計結果から算出するため、粒度を切り替えても元データは再集計しない)
+    # relative_accuracyを指定した場合は、中央値を時間単位のスケッチから近似計算する
+    agg_df = tb.aggregate_timeline(df_input, col_datetime, col_numeric, datetime_type, agg_type, relative_accuracy)
+    return agg_df.sort_values(by=col_datetime, ascending=True)
 
 # 時系列に対する1変数の推移の描画
 def plot_datetime_1param(df, col_datetime, col_numeric, plot_type, datetime_type):
-    # datetime_typeに応じてdf[col_datetime]のデータの中身を変更
-    if datetime_type == '日'  or datetime_type == '週':
-        df[col_datetime] = df[col_datetime].dt.strftime('%Y-%m-%d')
-    elif datetime_type == '月':
-        df[col_datetime] = df[col_datetime].dt.strftime('%Y-%m')
-    elif datetime_type == '時間':
-        df[col_datetime] = df[col_datetime].dt.strftime('%m-%d %H')
+    # datetime_typeに応じてdf[col_datetime]のデータの中身を変更(入力のDataFrameは書き換えない)
+    df = df.assign(**{col_datetime: tb.format_datetime(df[col_datetime], datetime_type)})
 
     fig, ax = plt.subplots()
     # plot_typeに応じてグラフを描き分ける
@@ -189,24 +171,14 @@ def plot_datetime_1param(df, col_datetime, col_numeric, plot_type, datetime_type
 
 # 文字列型×文字列型
 # ベースとなるクロス集計表を作成
-def cross_counts(df_input, col1, col2, threshold=0.05):
-    # st.session_state.dfに直接影響が出ないようコピーを作成
-    df = df_input.copy()
-    
+def cross_counts(df, col1, col2, threshold=0.05):
     # col1, col2に対して「その他」というカテゴリを与える(度数分布がthreshold以下)
-    counts_col1 = colname_counts(df, col1, False, threshold)
-    df['カテゴリ1'] = df[col1].map(counts_col1.set_index(col1)['カテゴリ'])
-    counts_col2 = colname_counts(df, col2, False, threshold)
-    df['カテゴリ2'] = df[col2].map(counts_col2.set_index(col2)['カテゴリ'])
-    
-    # クロス集計を行う
-    cross_tab = pd.crosstab(df['カテゴリ1'], df['カテゴリ2'])  
-    # 各カテゴリの要素数を計算
-    counts = cross_tab.stack().reset_index()
-    counts.columns = ['カテゴリ1', 'カテゴリ2', '要素数']
-     
-    # ピボットテーブルを作成
-    pivot_table = counts.pivot(index='カテゴリ1', columns='カテゴリ2', values='要素数')
+    # 入力のDataFrameはコピーせず、必要な2カラムのみを参照する
+    _, category1 = fag.bucket_categories(df[col1], threshold)
+    _, category2 = fag.bucket_categories(df[col2], threshold)
+
+    # カテゴリのコードから直接クロス集計表(ピボットテーブル)を作成する
+    pivot_table = fag.crosstab_codes(category1.rename('カテゴリ1'), category2.rename('カテゴリ2'))
 
     return pivot_table
     
@@ -251,52 +223,14 @@ def plot_cross_bar(df, col1, col2, normalize):
 # 3変数の集計
 # 日付×日付ごとにクロス集計
 def agg_datetime_2col_dataframe(df_input, datetime_type1, datetime_type2,
-                                agg_type, col_datetime1, col_datetime2, col_numeric):
-    df = df_input[[col_datetime1, col_datetime2, col_numeric]].copy()  # 必要カラムのみに絞りこみ
-
-    # datetime_type1に応じて日付カラムの粒度を変更
-    if datetime_type1 == '日':
-        df[col_datetime1] = df[col_datetime1].dt.date
-    elif datetime_type1 == '月':
-        df[col_datetime1] = df[col_datetime1].dt.to_period('M').dt.to_timestamp()
-    elif datetime_type1 == '週':
-        df[col_datetime1] = df[col_datetime1].dt.to_period('W').dt.to_timestamp()
-    elif datetime_type1 == '時間':
-        df[col_datetime1] = df[col_datetime1].dt.floor('H')
-    # datetime_type2に応じて日付カラムの粒度を変更
-    if datetime_type2 == '日':
-        df[col_datetime2] = df[col_datetime2].dt.date
-    elif datetime_type2 == '月':
-        df[col_datetime2] = df[col_datetime2].dt.to_period('M').dt.to_timestamp()
-    elif datetime_type2 == '週':
-        df[col_datetime2] = df[col_datetime2].dt.to_period('W').dt.to_timestamp()
-    elif datetime_type2 == '時間':
-        df[col_datetime2] = df[col_datetime2].dt.floor('H')
-
-    # 集計
-    if agg_type == '合計':
-        agg_df = df.groupby([col_datetime1, col_datetime2])[col_numeric].sum().reset_index()
-    elif agg_type == '平均':
-        agg_df = df.groupby([col_datetime1, col_datetime2])[col_numeric].mean().reset_index()
-    elif agg_type == '中央値':
-        agg_df = df.groupby([col_datetime1, col_datetime2])[col_numeric].median().reset_index()
-    elif agg_type == 'カウント':
-        agg_df = df.groupby([col_datetime1, col_datetime2])[col_numeric].count().reset_index()
-
-    # datetime_type1に応じてdf[col_datetime]のデータの中身を変更
-    if datetime_type1 == '日'  or datetime_type1 == '週':
-        agg_df[col_datetime1] = agg_df[col_datetime1].dt.strftime('%Y-%m-%d')
-    elif datetime_type1 == '月':
-        agg_df[col_datetime1] = agg_df[col_datetime1].dt.strftime('%Y-%m')
-    elif datetime_type1 == '時間':
-        agg_df[col_datetime1] = agg_df[col_datetime1].dt.strftime('%m-%d %H')
-    # datetime_type2に応じてdf[col_datetime]のデータの中身を変更
-    if datetime_type2 == '日'  or datetime_type2 == '週':
-        agg_df[col_datetime2] = agg_df[col_datetime2].dt.strftime('%Y-%m-%d')
-    elif datetime_type2 == '月':
-        agg_df[col_datetime2] = agg_df[col_datetime2].dt.strftime('%Y-%m')
-    elif datetime_type2 == '時間':
-        agg_df[col_datetime2] = agg_df[col_datetime2].dt.strftime('%m-%d %H')
+                                agg_type, col_datetime1, col_datetime2, col_numeric, relative_accuracy=None):
+    # datetime_type1, datetime_type2に応じて日付カラムの粒度を変更し、agg_typeに基づいて集計
+    agg_df = tb.aggregate_grouped(df_input, {col_datetime1: datetime_type1, col_datetime2: datetime_type2},
+                                  col_numeric, agg_type, relative_accuracy=relative_accuracy)
+
+    # datetime_type1, datetime_type2に応じてdf[col_datetime]のデータの中身を変更
+    agg_df[col_datetime1] = tb.format_datetime(agg_df[col_datetime1], datetime_type1)
+    agg_df[col_datetime2] = tb.format_datetime(agg_df[col_datetime2], datetime_type2)
 
     # アウトプット用にデータを整形
     agg_df = agg_df.sort_values(by=[col_datetime1, col_datetime2], ascending=True)
@@ -307,27 +241,31 @@ def agg_datetime_2col_dataframe(df_input, datetime_type1, datetime_type2,
     return agg_df
 
 # 文字列型×文字列型ごとにクロス集計
-def agg_category_2col_dataframe(df_input, col1, col2, col_numeric, agg_type, threshold1=0.05, threshold2=0.05):
-    # st.session_state.dfに直接影響が出ないようコピーを作成
-    df = df_input.copy()
-    
-    # col1, col2に対して「その他」というカテゴリを与える(度数分布がthreshold以下)
-    counts_col1 = colname_counts(df, col1, False, threshold1)
-    df['カテゴリ1'] = df[col1].map(counts_col1.set_index(col1)['カテゴリ'])
-    counts_col2 = colname_counts(df, col2, False, threshold1)
-    df['カテゴリ2'] = df[col2].map(counts_col2.set_index(col2)['カテゴリ'])
-
-    # 必要なカラムだけ抽出
-    df = df[['カテゴリ1', 'カテゴリ2', col_numeric]]
-    # agg_typeに応じて集計を実施
-    if agg_type == '合計':
-        agg_df = df.groupby(['カテゴリ1', 'カテゴリ2'])[col_numeric].sum().reset_index()
-    elif agg_type == '平均':
-        agg_df = df.groupby(['カテゴリ1', 'カテゴリ2'])[col_numeric].mean().reset_index()
-    elif agg_type == '中央値':
-        agg_df = df.groupby(['カテゴリ1', 'カテゴリ2'])[col_numeric].median().reset_index()
-    elif agg_type == 'カウント':
-        agg_df = df.groupby(['カテゴリ1', 'カテゴリ2'])[col_numeric].count().reset_index()
+def agg_category_2col_dataframe(df_input, col1, col2, col_numeric, agg_type, threshold1=0.05, threshold2=0.05,
+                                relative_accuracy=None):
+    if agg_type in rc.CUBE_AGGS:
+        # col1, col2の要素の組み合わせ毎に集計したキューブに対して「その他」というカテゴリを与え(度数分布がthreshold以下)、
+        # agg_typeに応じて集計を実施(閾値・集計方法を変更した場合も元データは再集計しない)
+        cube = rc.get_cube(df_input, [col1, col2], col_numeric)
+        keys = [fag.bucket_categories(cube[col1], threshold1, cube['rows'])[1].rename('カテゴリ1'),
+                fag.bucket_categories(cube[col2], threshold1, cube['rows'])[1].rename('カテゴリ2')]
+        agg_df = rc.rollup(cube, keys, agg_type).rename(col_numeric).reset_index()
+    elif agg_type == '中央値' and relative_accuracy is not None:
+        # 中央値はスケッチから近似計算する
+        sketch = rc.get_sketch(df_input, [col1, col2], col_numeric, relative_accuracy)
+        keys = [fag.bucket_categories(sketch[col1], threshold1, sketch[qs.COUNT_LABEL])[1].rename('カテゴリ1'),
+                fag.bucket_categories(sketch[col2], threshold1, sketch[qs.COUNT_LABEL])[1].rename('カテゴリ2')]
+        agg_df = qs.sketch_quantile(sketch, keys, 0.5).rename(col_numeric).reset_index()
+    else:
+        # 必要なカラムのみに絞りこみ(st.session_state.df全体のコピーは作成しない)
+        df = fag.project(df_input, [col1, col2, col_numeric])
+
+        # col1, col2に対して「その他」というカテゴリを与える(度数分布がthreshold以下)
+        df = df.assign(カテゴリ1=fag.bucket_categories(df[col1], threshold1)[1],
+                       カテゴリ2=fag.bucket_categories(df[col2], threshold1)[1])
+
+        # agg_typeに応じて集計を実施
+        agg_df = fag.grouped_agg(df, ['カテゴリ1', 'カテゴリ2'], col_numeric, {col_numeric: fag.AGG_FUNCS[agg_type]})
 
     agg_df = agg_df.sort_values(by=['カテゴリ1', 'カテゴリ2'], ascending=True)
     agg_df = pd.pivot(agg_df, index='カテゴリ1', columns='カテゴリ2', values=col_numeric)
@@ -338,41 +276,15 @@ def agg_category_2col_dataframe(df_input, col1, col2, col_numeric, agg_type, thr
 
 # 文字列型×日付型ごとにクロス集計
 def agg_category_datetime_dataframe(df_input, col_category, col_datetime, col_numeric,
-                                                        agg_type, threshold_input, datetime_type_input):
-    # st.session_state.dfに直接影響が出ないようコピーを作成
-    df = df_input.copy()
-
-    # col_categoryに対して「その他」というカテゴリを与える(度数分布がthreshold_input以下)
-    counts_col1 = colname_counts(df, col_category, False, threshold_input)
-    df['カテゴリ'] = df[col_category].map(counts_col1.set_index(col_category)['カテゴリ'])
-
-    # datetime_type_inputに応じて日付カラムの粒度を変更
-    if datetime_type_input == '日':
-        df[col_datetime] = df[col_datetime].dt.date
-    elif datetime_type_input == '月':
-        df[col_datetime] = df[col_datetime].dt.to_period('M').dt.to_timestamp()
-    elif datetime_type_input == '週':
-        df[col_datetime] = df[col_datetime].dt.to_period('W').dt.to_timestamp()
-    elif datetime_type_input == '時間':
-        df[col_datetime] = df[col_datetime].dt.floor('H')
-
-    # 集計
-    if agg_type == '合計':
-        agg_df = df.groupby([col_datetime, 'カテゴリ'])[col_numeric].sum().reset_index()
-    elif agg_type == '平均':
-        agg_df = df.groupby([col_datetime, 'カテゴリ'])[col_numeric].mean().reset_index()
-    elif agg_type == '中央値':
-        agg_df = df.groupby([col_datetime, 'カテゴリ'])[col_numeric].median().reset_index()
-    elif agg_type == 'カウント':
-        agg_df = df.groupby([col_datetime, 'カテゴリ'])[col_numeric].count().reset_index()
-    
+                                                        agg_type, threshold_input, datetime_type_input,
+                                                        relative_accuracy=None):
+    # col_categoryに対して「その他」というカテゴリを与え(度数分布がthreshold_input以下)、
+    # datetime_type_inputに応じて日付カラムの粒度を変更した上で集計
+    agg_df = tb.aggregate_grouped(df_input, {col_datetime: datetime_type_input}, col_numeric, agg_type,
+                                  category=(col_category, threshold_input), relative_accuracy=relative_accuracy)
+
     # datetime_type_inputに応じてdf[col_datetime]のデータの中身を変更
-    if datetime_type_input == '日'  or datetime_type_input == '週':
-        agg_df[col_datetime] = agg_df[col_datetime].dt.strftime('%Y-%m-%d')
-    elif datetime_type_input == '月':
-        agg_df[col_datetime] = agg_df[col_datetime].dt.strftime('%Y-%m')
-    elif datetime_type_input == '時間':
-        agg_df[col_datetime] = agg_df[col_datetime].dt.strftime('%m-%d %H')
+    agg_df[col_datetime] = tb.format_datetime(agg_df[col_datetime], datetime_type_input)
 
     agg_df = agg_df.sort_values(by=[col_datetime, 'カテゴリ'], ascending=True)
     agg_df = pd.pivot(agg_df, index=col_datetime, columns='カテゴリ', values=col_numeric)
@@ -0,0 +1,114 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import streamlit as st
+import numpy as np
+import pandas as pd
+from pandas.tseries.api import guess_datetime_format
+import functions.data_version as dv
+
+# 複数カラムの型変換を並列で実行する際のスレッド数の上限
+MAX_WORKERS = min(4, os.cpu_count() or 1)
+# 日付のフォーマットを推定する際に使用するサンプル数
+DATETIME_SAMPLE_SIZE = 1000
+# サンプルから推定できなかった場合に試す日付のフォーマット
+DATETIME_FORMATS = [
+    "%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d",
+    "%Y/%m/%d %H:%M:%S", "%Y/%m/%d %H:%M", "%Y/%m/%d",
+    "%Y%m%d", "%Y年%m月%d日",
+]
+
+##### 日付型への変換
+# サンプルを基に、最も多くの値を変換できる日付のフォーマットを推定する(推定できない場合はNone)
+def infer_datetime_format(values):
+    sample = pd.Index(values[:DATETIME_SAMPLE_SIZE]).astype(str)
+    # 先頭の値から推定したフォーマットを優先して試す
+    candidates = [guess_datetime_format(value) for value in sample[:5]]
+    candidates = list(dict.fromkeys([fmt for fmt in candidates if fmt] + DATETIME_FORMATS))
+
+    best_format, best_count = None, 0
+    for fmt in candidates:
+        count = pd.to_datetime(sample, format=fmt, errors='coerce').notna().sum()
+        if count > best_count:
+            best_format, best_count = fmt, count
+        if best_count == len(sample):
+            break
+    return best_format
+
+# 文字列のカラムを日付型に変換する
+# 日次データのように同じ値が繰り返し出現することが多いため、ユニークな値のみを変換して全体に展開する
+def parse_datetime(series):
+    codes, uniques = pd.factorize(series)
+    fmt = infer_datetime_format(uniques)
+    if fmt is None:
+        parsed = pd.to_datetime(uniques, errors='coerce')
+    else:
+        # フォーマットを固定することで、1要素ずつの推定を行わずにまとめて変換できる
+        parsed = pd.to_datetime(uniques.astype(str), format=fmt, errors='coerce')
+    converted = pd.Series(parsed.take(codes, allow_fill=True, fill_value=pd.NaT),
+                          index=series.index, name=series.name)
+
+    # 変換できなかった値の件数と、その例を集計する
+    occurrences = np.bincount(codes[codes >= 0], minlength=len(uniques))
+    failed = np.asarray(parsed.isna())
+    return converted, int(occurrences[failed].sum()), uniques[failed][:5].tolist()
+
+##### 型変換
+# 1つのカラムを指定した型に変換し、変換できずに欠損値となった値の件数・例を合わせて返す
+def convert_series(series, new_type):
+    if new_type == "日付型" and (pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series)
+                                or isinstance(series.dtype, pd.CategoricalDtype)):
+        return parse_datetime(series)
+
+    if new_type == "数値型":
+        converted = pd.to_numeric(series, errors='coerce')
+    elif new_type == "文字列型":
+        converted = series.astype('string')
+    elif new_type == "日付型":
+        converted = pd.to_datetime(series, errors='coerce')
+    else:
+        raise ValueError(f"未対応のデータ型です: {new_type}")
+    failed = converted.isna() & series.notna()
+    return converted, int(failed.sum()), series[failed].unique()[:5].tolist()
+
+# 各カラムに最後に適用した型変換を取得する
+def applied_conversions():
+    return dict(st.session_state.transforms['conversions'])
+
+# 指定された型変換のうち、未適用のものだけを元データに適用する
+# requested: カラム名 → 変換後のデータ型
+# 戻り値: カラム名 → 変換結果(変換できなかった値の件数・例、変換を適用したかどうか)
+def apply_conversions(requested):
+    applied = applied_conversions()
+    # 全ての値が変換できずに適用を見送った変換は、再実行時に繰り返さない
+    rejected = st.session_state.setdefault('rejected_conversions', set())
+    pending = {column: new_type for column, new_type in requested.items()
+               if applied.get(column) != new_type and (dv.base_key(), column, new_type) not in rejected}
+    if not pending:
+        return {}
+
+    df_original = st.session_state.df_original
+    if len(pending) == 1:
+        results = {column: convert_series(df_original[column], new_type) for column, new_type in pending.items()}
+    else:
+        # pd.to_numeric, pd.to_datetimeは大きな配列の処理中にGILを解放するため、カラム単位で並列に変換する
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = {column: executor.submit(convert_series, df_original[column], new_type)
+                       for column, new_type in pending.items()}
+            results = {column: future.result() for column, future in futures.items()}
+
+    report = {}
+    converted_columns = {}
+    for column, (converted, n_failed, failed_examples) in results.items():
+        # 値が存在するにもかかわらず全て欠損値になる場合は、カラムを壊さないよう変換を適用しない
+        applied_flag = not (n_failed > 0 and converted.isna().all())
+        if applied_flag:
+            converted_columns[column] = (pending[column], converted)
+        else:
+            rejected.add((dv.base_key(), column, pending[column]))
+        report[column] = {'new_type': pending[column], 'n_failed': n_failed,
+                          'failed_examples': failed_examples, 'applied': applied_flag}
+
+    # 変換結果をまとめて元データに反映し、分析用のデータは1度だけ作り直す
+    if converted_columns:
+        dv.convert_columns(converted_columns)
+    return report
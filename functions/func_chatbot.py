@@ -5,13 +5,18 @@ import ast
 from langchain.chat_models import ChatOpenAI
 from langchain.prompts import PromptTemplate, FewShotPromptTemplate
 from langchain.chains import LLMChain, ConversationChain
-from langchain_experimental.utilities import PythonREPL
 from langchain.agents import Tool
 from langchain.memory import ConversationBufferMemory
 from langchain.memory import ConversationSummaryMemory
 from langchain.schema import SystemMessage
 from langchain.schema import HumanMessage, OutputParserException
 from langchain.output_parsers import RegexParser
+from langchain_community.callbacks import get_openai_callback
+import functions.data_version as dv
+import functions.execution_snapshot as es
+import functions.code_workers as cw
+import functions.llm_cache as lc
+import functions.chat_context as cc
 
 ###########################
 # APIの取得
@@ -19,6 +24,18 @@ from langchain.output_parsers import RegexParser
 def use_secret():
     api_key = st.secrets["OPENAI_API_KEY"]
 
+# コード生成に使用するモデル
+MODEL_NAME = "gpt-4"
+
+# ChatOpenAIのクライアントは1度だけ作成し、セッション間で共有する
+@st.cache_resource
+def get_llm(model_name=MODEL_NAME):
+    return ChatOpenAI(
+        temperature=0,
+        model_name=model_name,
+        openai_api_key=st.secrets["OPENAI_API_KEY"]
+    )
+
 ###########################
 # チャットボットとしての基本機能
 ########################### 
@@ -29,6 +46,10 @@ def init_messages(clear_conversation):
         st.session_state.messages = []
     if clear_conversation == True or "execution_results" not in st.session_state:
         st.session_state.execution_results = []
+    if clear_conversation == True or "chat_summary" not in st.session_state:
+        st.session_state.chat_summary = {'turns': 0, 'lines': []} # 会話の履歴に含めなかった分析内容の要約(functions/chat_context.py)
+    if clear_conversation == True or "token_usage" not in st.session_state:
+        st.session_state.token_usage = [] # リクエスト毎のトークン数
 
 # chatの履歴を格納する関数
 @st.fragment
@@ -56,8 +77,17 @@ def remove_surrounding_quotes_if_needed(parsed_output: str) -> str:
         # もしパースできなかった場合は、もともとの文字列をそのまま返す
         return parsed_output
 
+# 会話の履歴のうち、今回の分析内容より前のメッセージ
+# (画面側で分析内容をst.session_state.messagesに追加してからコードを生成するため、末尾の分析内容を除く)
+def previous_messages(analysis_query):
+    messages = st.session_state.messages
+    if messages and messages[-1] == {"role": "user", "content": analysis_query}:
+        return messages[:-1]
+    return messages
+
+# llm: コード生成に使用するLLM(Noneの場合はChatOpenAI、オフラインで動作を確認する場合はスタブを渡す)
 @st.fragment
-def generate_code(analysis_query, summary_flag=False):
+def generate_code(analysis_query, summary_flag=False, llm=None, use_cache=True):
     # --- Few-shot で与える入出力例の定義 ---
     examples = [
         {
@@ -68,7 +98,7 @@ def generate_code(analysis_query, summary_flag=False):
                 import numpy as np
                 import streamlit as st
 
-                df = st.session_state.df.copy()
+                # 分析用のデータは変数dfに読み込み済み(copy()は不要)
 
                 # 売り上げ金額を計算
                 df['Sales'] = df['Quantity'] * df['Unit_Price']
@@ -95,7 +125,7 @@ def generate_code(analysis_query, summary_flag=False):
                 import streamlit as st
                 import matplotlib.pyplot as plt
 
-                df = st.session_state.df.copy()
+                # 分析用のデータは変数dfに読み込み済み(copy()は不要)
 
                 # 売り上げ金額を計算
                 df['Sales'] = df['Quantity'] * df['Unit_Price']
@@ -145,7 +175,7 @@ def generate_code(analysis_query, summary_flag=False):
 
     # --- Few-shot プロンプト全体の構成 ---
     prefix = """
-        DataFrame 'st.session_state.df' には、以下のカラムが存在します。
+        DataFrame 'df' (st.session_state.df と同じデータ) には、以下のカラムが存在します。
 
         - 数値型カラム: {numeric_columns}
         - 文字列型カラム: {non_numeric_columns}
@@ -160,7 +190,8 @@ def generate_code(analysis_query, summary_flag=False):
         # **要件の詳細**
         - 過去に実行したコードがある場合は、そのコードをベースに書き換えを実施してください
         - 分析結果の解釈に必要な数値やグラフは漏れが無いように出力してください。
-        - 加工するDataFrameは変数 `st.session_state.df` であり、結果は変数 `result` に格納するものとします。  
+        - 加工するDataFrameは変数 `df` であり、結果は変数 `result` に格納するものとします。  
+        - `df` は読み込み済みです。カラムの追加・値の変更を行っても元のデータには影響しないため、`copy()` は行わないでください。
         - 必要に応じて、以下のライブラリを利用してください。
           - pandas
           - numpy
@@ -172,8 +203,7 @@ def generate_code(analysis_query, summary_flag=False):
         import pandas as pd
         import numpy as np
         import streamlit as st
-        # データをdfに読み込む
-        df = st.session_state.df.copy()
+        # 分析用のデータは変数dfに読み込み済み(元のデータを変更しないため、copy()は不要)
         # ここにコードを書く
         result = [] # 出力したい実行結果を格納するリスト。必要なオブジェクトを適宜appendしていく
         
@@ -213,11 +243,19 @@ def generate_code(analysis_query, summary_flag=False):
     full_prompt = filled_prompt + "\n\n" + format_instructions
 
     # --- LangChainのChatOpenAI を利用 ---
-    llm = ChatOpenAI(
-        temperature=0,
-        model_name="gpt-4",
-        openai_api_key=st.secrets["OPENAI_API_KEY"]
-    )
+    if llm is None:
+        llm = get_llm()
+    # --- トークン数の上限に収まるよう絞った会話の履歴 ---
+    context = cc.build_context(previous_messages(analysis_query), lc.model_name(llm))
+    # --- 生成結果のキャッシュのキー(分析内容・カラムの一覧・会話の履歴・モデルが同じ場合は同じコードを返す) ---
+    cache_key = lc.cache_key('generate', {
+        'analysis_query': lc.normalize_query(analysis_query),
+        'columns': [st.session_state.numeric_columns, st.session_state.non_numeric_columns, st.session_state.datetime_columns],
+        'history': lc.history_digest(context['messages']),
+        'history_summary': context['summary'],
+        'summary': summary_flag,
+        'model': lc.model_name(llm),
+    })
     
     # --- 要約フラグに応じたメモリの設定 ---
     if summary_flag:
@@ -230,22 +268,35 @@ def generate_code(analysis_query, summary_flag=False):
         "あなたは優秀なデータアナリストです。"
         "入力された要件に沿って分析を行うpythonコードを出力してください。"
         "その際、出力はコードのみとし、その他の説明は絶対に含めないで下さい。"
-        "分析に使用するデータは常にst.session_state.dfになります。dfにcopy()してから分析を開始してください。"
+        "分析に使用するデータは変数dfに読み込み済みです(st.session_state.dfと同じデータ)。"
+        "dfを変更しても元のデータには影響しないため、copy()は行わずにdfをそのまま使用してください。"
         "また、実行結果はstreamlitで表示させてください。"
     )
     memory.chat_memory.add_message(SystemMessage(content=system_message))
     
-    # st.session_state.messages の内容を ConversationMemory に反映
-    for message in st.session_state.messages:
+    # 履歴に含めなかった過去の分析内容の要約を追加
+    if context['summary']:
+        memory.chat_memory.add_message(SystemMessage(content="これまでに実施した分析の一覧(要約):\n" + context['summary']))
+    
+    # 絞った会話の履歴を ConversationMemory に反映
+    for message in context['messages']:
         if message['role'] == 'user':
             memory.chat_memory.add_user_message(message['content'])
         elif message['role'] == 'assistant':
             memory.chat_memory.add_ai_message(message['content'])
     
-    # --- ConversationChain の作成 ---
-    chain = ConversationChain(llm=llm, memory=memory, verbose=True)
-    # --- ChatGPT へ問い合わせ ---
-    generated_response = chain.predict(input=full_prompt)
+    # --- 同じ条件で生成済みの場合は、ChatGPT へ問い合わせずにキャッシュを使用(use_cache=Falseの場合は必ず問い合わせる) ---
+    generated_response = lc.load_cached(cache_key) if use_cache else None
+    callback = None
+    if generated_response is None:
+        # --- ConversationChain の作成 ---
+        chain = ConversationChain(llm=llm, memory=memory, verbose=True)
+        # --- ChatGPT へ問い合わせ(APIで使用したトークン数を記録する) ---
+        with get_openai_callback() as callback:
+            generated_response = chain.predict(input=full_prompt)
+    # --- キャッシュへの保存は、生成したコードの実行に成功した場合のみ行う(update_cache) ---
+    st.session_state.llm_cache_pending = (cache_key, generated_response, callback is None)
+    cc.record_usage('生成', context, full_prompt, lc.model_name(llm), callback)
     # --- LLM の出力からコード部分のみを抽出 ---
     # RegexParser の定義（コードブロックの中身を抽出）
     parser = RegexParser(
@@ -265,14 +316,22 @@ def generate_code(analysis_query, summary_flag=False):
 ###########################
 # 生成したコードを実行する関数
 ###########################
+# 生成したコードをワーカープロセスで実行し、標準出力と実行結果のスナップショット(表示する要素・実行時のデータの状態)を返す
+# コード内のstreamlitの呼び出しは表示せずに記録する(表示はes.renderで行う)
+def run_code(code):
+    output, elements = cw.run(code)
+    version = dv.version_key() if st.session_state.get('df') is not None else None
+    return output, {'elements': elements, 'version': version, 'bytes': es.snapshot_bytes(elements), 'trimmed': False}
+
 @st.fragment
 def execute_code(code, user_input):
-    python_repl = PythonREPL()
     try:
-        result = python_repl.run(code)
-        # 結果をセッション状態に保存する(ユーザーの指示と実行結果を交互に保存)
-        st.session_state["execution_results"].append(user_input)
-        st.session_state["execution_results"].append(code) # コードを保存し、それを実行して表示させる
+        result, snapshot = run_code(code)
+        es.render(snapshot['elements'])
+        # 結果をセッション状態に保存する(過去の実行履歴はコードを再実行せず、スナップショットを表示する)
+        st.session_state["execution_results"].append({'prompt': user_input, 'code': code, 'output': result, **snapshot})
+        es.trim_history(st.session_state["execution_results"])
+        update_cache(result)
         return result
     except Exception as e:
         import traceback
@@ -281,13 +340,35 @@ def execute_code(code, user_input):
         detailed_error_trace = ''.join(tb_exception.format(chain=True))
         st.error("コードの実行中にエラーが発生しました。再生成を試みます。")
         st.error("Error:\n" +  detailed_error_trace)
+        update_cache(detailed_error_trace)
         return  detailed_error_trace
+
+# 直前に生成したコードの実行結果に応じて、生成結果のキャッシュを更新する
+# 実行に成功した場合のみ保存し、キャッシュから取得したコードの実行に失敗した場合はキャッシュを削除する
+# (失敗したコードを、同じ分析内容の入力時に再度使用しないようにする)
+def update_cache(result):
+    pending = st.session_state.pop('llm_cache_pending', None)
+    if pending is None:
+        return
+    cache_key, generated_response, cached = pending
+    if "Error" in result:
+        if cached:
+            lc.delete_cache(cache_key)
+    elif not cached:
+        lc.save_cache(cache_key, generated_response)
+
+# 過去の実行結果のコードを再実行し、標準出力(エラーの内容)とスナップショットを更新する
+def rerun_execution(execution):
+    output, snapshot = run_code(execution['code'])
+    execution.update(snapshot, output=output)
+    es.trim_history(st.session_state["execution_results"], keep=execution)
     
 ###########################
 # 生成したコードにエラーが出た場合に再生成を試みる関数
 ###########################
+# llm: コード生成に使用するLLM(Noneの場合はChatOpenAI、オフラインで動作を確認する場合はスタブを渡す)
 @st.fragment
-def re_generate_code(generated_code, result, summary_flag=False):
+def re_generate_code(generated_code, result, summary_flag=False, llm=None, use_cache=True):
     prompt_template = """
         下記のコードを実行したところ、後述のエラーが発生しました。
         要因を特定し、コードの修正案を出力してください。
@@ -301,8 +382,7 @@ def re_generate_code(generated_code, result, summary_flag=False):
         import pandas as pd
         import numpy as np
         import streamlit as st
-        # データをdfに読み込む
-        df = st.session_state.df.copy()
+        # 分析用のデータは変数dfに読み込み済み(元のデータを変更しないため、copy()は不要)
         # ここにコードを書く
         result = [] # 出力したい実行結果を格納するリスト。必要なオブジェクトを適宜appendしていく
         
@@ -329,15 +409,23 @@ def re_generate_code(generated_code, result, summary_flag=False):
     # --- プロンプトに変数を埋め込み、フォーマット指示を追加 ---
     filled_prompt = prompt.format(
             code=generated_code,
-            error=result
+            error=cc.shorten_result(result)
     )
     full_prompt = filled_prompt + "\n\n" + format_instructions
 
-    llm = ChatOpenAI(
-        temperature=0, 
-        model_name="gpt-4",
-        openai_api_key=st.secrets["OPENAI_API_KEY"]
-    )
+    if llm is None:
+        llm = get_llm()
+    # --- トークン数の上限に収まるよう絞った会話の履歴(プロンプトに含めるコード・エラーは除く) ---
+    context = cc.build_context(st.session_state.messages, lc.model_name(llm), exclude=(generated_code, result))
+    # --- 生成結果のキャッシュのキー(コード・エラー・会話の履歴・モデルが同じ場合は同じコードを返す) ---
+    cache_key = lc.cache_key('regenerate', {
+        'code': generated_code,
+        'error': cc.shorten_result(result),
+        'history': lc.history_digest(context['messages']),
+        'history_summary': context['summary'],
+        'summary': summary_flag,
+        'model': lc.model_name(llm),
+    })
 
     # --- 要約フラグに応じたメモリの設定 ---
     if summary_flag:
@@ -350,21 +438,34 @@ def re_generate_code(generated_code, result, summary_flag=False):
         "あなたは優秀なデータアナリストです。"
         "入力された要件に沿って分析を行うpythonコードを出力してください。"
         "その際、出力はコードのみとし、その他の説明は絶対に含めないで下さい。"
-        "分析に使用するデータは常にst.session_state.dfになります。dfにcopy()してから分析を開始してください。"
+        "分析に使用するデータは変数dfに読み込み済みです(st.session_state.dfと同じデータ)。"
+        "dfを変更しても元のデータには影響しないため、copy()は行わずにdfをそのまま使用してください。"
         "また、実行結果はstreamlitで表示させてください。"
     )
     memory.chat_memory.add_message(SystemMessage(content=system_message))
     
-    # st.session_state.messagesの内容をConversationMemoryに反映
-    for message in st.session_state.messages:
+    # 履歴に含めなかった過去の分析内容の要約を追加
+    if context['summary']:
+        memory.chat_memory.add_message(SystemMessage(content="これまでに実施した分析の一覧(要約):\n" + context['summary']))
+    
+    # 絞った会話の履歴を ConversationMemory に反映
+    for message in context['messages']:
         if message['role'] == 'user':
             memory.chat_memory.add_user_message(message['content'])
         elif message['role'] == 'assistant':
             memory.chat_memory.add_ai_message(message['content'])
     
-    chain = ConversationChain(llm=llm, memory=memory, verbose=True)
-    # --- ChatGPT へ問い合わせ ---
-    generated_response = chain.predict(input=full_prompt)
+    # --- 同じ条件で生成済みの場合は、ChatGPT へ問い合わせずにキャッシュを使用(use_cache=Falseの場合は必ず問い合わせる) ---
+    generated_response = lc.load_cached(cache_key) if use_cache else None
+    callback = None
+    if generated_response is None:
+        chain = ConversationChain(llm=llm, memory=memory, verbose=True)
+        # --- ChatGPT へ問い合わせ(APIで使用したトークン数を記録する) ---
+        with get_openai_callback() as callback:
+            generated_response = chain.predict(input=full_prompt)
+    # --- キャッシュへの保存は、生成したコードの実行に成功した場合のみ行う(update_cache) ---
+    st.session_state.llm_cache_pending = (cache_key, generated_response, callback is None)
+    cc.record_usage('再生成', context, full_prompt, lc.model_name(llm), callback)
     # --- LLM の出力からコード部分のみを抽出 ---
     # RegexParser の定義（コードブロックの中身を抽出）
     parser = RegexParser(
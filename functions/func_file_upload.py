@@ -0,0 +1,139 @@
+import streamlit as st
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+# 分割読み込み時に1回で読み込む行数
+CHUNK_SIZE = 200_000
+# 読み込み中に表示するプレビューの行数
+PREVIEW_ROWS = 1000
+
+##### 大容量ファイルの分割読み込み
+# CSVを一定行数ごとに読み込み、プレビュー・データサイズを逐次更新しながらDataFrameを構築する
+# 読み込んだチャンクはすぐにArrow形式に変換して破棄し、全てのチャンクを読み込んだ後にカラム単位でDataFrameに変換する
+# 変換したカラムはArrow形式のデータから削除するため、ピーク時のメモリ使用量は
+#   未変換のカラムのArrow形式のデータ + 変換済みのカラム + 変換中の1カラム分
+# となり、DataFrame1つ分 + 1カラム分程度に収まる(全チャンクと結合後のDataFrameを同時に保持しない)
+# (文字列はArrow形式の方がpythonの文字列オブジェクトより小さいため、読み込み中はDataFrameより小さい)
+def load_data_chunked(uploaded_file, chunksize=CHUNK_SIZE):
+    uploaded_file.seek(0)
+    total_bytes = max(uploaded_file.size, 1)
+
+    # 読み込みの途中経過を表示するための領域を確保
+    progress_bar = st.progress(0.0, text="CSVファイルを読み込み中です…")
+    shape_area = st.empty()
+    preview_area = st.empty()
+
+    tables = []
+    column_types = {} # カラムごとに、チャンク毎に推定されたデータ型(Arrow形式)を記録
+    n_rows = 0
+    # チャンク内では型を一括で推定し(low_memory=False)、1つのカラムに数値と文字列が混在しないようにする
+    for chunk in pd.read_csv(uploaded_file, chunksize=chunksize, low_memory=False):
+        # 先頭のチャンクを読み込んだ時点でプレビューを表示
+        if not tables:
+            preview_area.dataframe(chunk.head(PREVIEW_ROWS))
+        n_rows += len(chunk)
+        shape_area.write(f"読み込み済みのデータのサイズ: {(n_rows, chunk.shape[1])}")
+
+        table = chunk_to_table(chunk)
+        del chunk
+        tables.append(table)
+        for field in table.schema:
+            column_types.setdefault(field.name, set()).add(field.type)
+        progress_bar.progress(min(uploaded_file.tell() / total_bytes, 1.0),
+                              text="CSVファイルを読み込み中です…")
+
+    if not tables:
+        # ヘッダーのみ or 空のファイルの場合は一括で読み込む
+        uploaded_file.seek(0)
+        df = pd.read_csv(uploaded_file)
+    else:
+        # チャンクによって推定結果が異なるカラムは、一括読み込み時と同じく文字列として読み直す
+        # (整数・小数のみの場合は変換時に小数に揃える)
+        mixed_columns = [col for col, types in column_types.items()
+                         if len(types) > 1 and not all(pa.types.is_integer(t) or pa.types.is_floating(t) for t in types)]
+        if mixed_columns:
+            progress_bar.progress(1.0, text="データ型が混在するカラムを文字列として読み込み中です…")
+            read_text_columns(uploaded_file, tables, mixed_columns, chunksize)
+        df = tables_to_frame(tables)
+        del tables
+
+    # 途中経過の表示を削除
+    progress_bar.empty()
+    shape_area.empty()
+    preview_area.empty()
+    return df
+
+# チャンクをArrow形式に変換する
+# 数値と文字列などが混在してArrow形式に変換できないカラムは、欠損値以外を文字列に変換する
+def chunk_to_table(chunk):
+    arrays = []
+    for col in chunk.columns:
+        try:
+            arrays.append(pa.array(chunk[col], from_pandas=True))
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            arrays.append(pa.array(chunk[col].map(str, na_action='ignore'), type=pa.string(), from_pandas=True))
+    return pa.Table.from_arrays(arrays, names=[str(col) for col in chunk.columns])
+
+# チャンク毎のArrow形式のデータを、カラム単位でDataFrameに変換する
+# 変換はチャンク毎に行い(文字列の重複排除に使用するメモリをチャンク1つ分に抑える)、結合後にArrow形式のデータから削除する
+# チャンクによって整数・小数が異なるカラムは、結合時に小数に揃える(pd.concatと同じ)
+def tables_to_frame(tables):
+    columns = {}
+    for col in tables[0].column_names:
+        column = pd.concat([table.column(col).to_pandas() for table in tables], ignore_index=True)
+        tables[:] = [table.drop_columns([col]) for table in tables]
+        # 文字列型の欠損値はNoneになるため、pd.read_csvと同じくNaNに揃える
+        if pd.api.types.is_object_dtype(column):
+            column = column.fillna(np.nan)
+        columns[col] = column
+    # カラム毎の配列をそのまま使用し、データ型毎の結合(コピー)を行わない
+    return pd.DataFrame(columns, copy=False)
+
+# 指定したカラムのみを文字列として読み直し、チャンク毎のArrow形式のデータを置き換える
+# (読み直す際もチャンク単位で読み込み、同じ行数で区切るため、チャンクの境界は読み込み時と一致する)
+def read_text_columns(uploaded_file, tables, columns, chunksize):
+    uploaded_file.seek(0)
+    reader = pd.read_csv(uploaded_file, usecols=columns, dtype=str, chunksize=chunksize)
+    for i, text_chunk in enumerate(reader):
+        table = tables[i]
+        for col in columns:
+            array = pa.array(text_chunk[col], type=pa.string(), from_pandas=True)
+            table = table.set_column(table.schema.get_field_index(col), col, array)
+        tables[i] = table
+
+##### データ型の圧縮(メモリ節約モード)
+# ユニーク数がレコード数に対してこの割合以下の文字列型カラムはカテゴリ型に変換する
+CATEGORY_RATIO = 0.5
+
+# 数値型は値が変わらない範囲で最小のビット幅に、ユニーク数の少ない文字列型はカテゴリ型に変換する
+def compact_dtypes(df, category_ratio=CATEGORY_RATIO):
+    dtypes_before = df.dtypes
+    memory_before = df.memory_usage(index=False, deep=True)
+    # 浅いコピーに対してカラムを置き換え、引数のDataFrameには影響を与えない
+    df = df.copy(deep=False)
+
+    for col in df.columns:
+        series = df[col]
+        if pd.api.types.is_bool_dtype(series):
+            continue
+        elif pd.api.types.is_integer_dtype(series):
+            df[col] = pd.to_numeric(series, downcast='integer')
+        elif pd.api.types.is_float_dtype(series):
+            downcast = series.astype('float32')
+            # 精度が落ちない場合のみfloat32に変換する
+            if downcast.astype(series.dtype).equals(series):
+                df[col] = downcast
+        elif pd.api.types.is_object_dtype(series):
+            if series.nunique() <= len(series) * category_ratio:
+                df[col] = series.astype('category')
+
+    # 変換前後のデータ型・メモリ使用量をまとめる
+    memory_after = df.memory_usage(index=False, deep=True)
+    report = pd.DataFrame({
+        '変換前のデータ型': dtypes_before.astype(str),
+        '変換後のデータ型': df.dtypes.astype(str),
+        '変換前のメモリ(MB)': memory_before / 1024**2,
+        '変換後のメモリ(MB)': memory_after / 1024**2,
+    })
+    return df, report
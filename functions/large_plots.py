@@ -0,0 +1,67 @@
+import numpy as np
+
+##############################
+#
+# 大規模データ向けの簡略化した描画
+# 行数が閾値を超える場合は全ての行を描画せず、ビン毎に集計したレコード数を描画する
+# (描画にかかる時間が行数に比例する程度に抑えられ、重なった点で読めなくなることも防げる)
+#
+##############################
+
+# 簡略化した描画に切り替える行数の既定値
+DEFAULT_THRESHOLD = 100_000
+# ヒストグラムのビン数
+HIST_BINS = 100
+# KDEを計算する格子点の数
+KDE_GRID_SIZE = 1024
+# 散布図の代わりに描画する六角形ビンの数(横方向)
+HEXBIN_GRIDSIZE = 60
+
+# 欠損値・無限大を除いた値をnumpyの配列として取得する
+def finite_values(series):
+    values = series.to_numpy(dtype=float, na_value=np.nan)
+    return values[np.isfinite(values)]
+
+# グラフの右上に注記を追加する
+def add_note(ax, text):
+    ax.text(0.99, 0.99, text, transform=ax.transAxes, ha='right', va='top', fontsize=8,
+            bbox={'facecolor': 'white', 'alpha': 0.7, 'edgecolor': 'none'})
+
+##### ヒストグラム
+# 値を細かい格子点に割り当てた上で、ガウスカーネルとの畳み込みをFFTで計算したKDE(確率密度)を返す
+# バンド幅はseabornの既定値と同じScottの方法で決める(値が1種類以下の場合はNone)
+def binned_kde(values, grid_size=KDE_GRID_SIZE):
+    if len(values) < 2 or values.std() == 0:
+        return None
+    bandwidth = values.std(ddof=1) * len(values) ** (-1 / 5)
+    # 両端にカーネルの裾の分の余白をとる
+    counts, edges = np.histogram(values, bins=grid_size,
+                                 range=(values.min() - 3 * bandwidth, values.max() + 3 * bandwidth))
+    step = edges[1] - edges[0]
+
+    # 格子点の間隔毎のカーネルの値(負の方向の間隔は配列の後半に格納し、0埋めで循環を防ぐ)
+    n_fft = 2 * grid_size
+    offsets = np.arange(n_fft)
+    offsets = np.where(offsets < grid_size, offsets, offsets - n_fft) * step
+    kernel = np.exp(-0.5 * (offsets / bandwidth) ** 2)
+    density = np.fft.irfft(np.fft.rfft(counts, n_fft) * np.fft.rfft(kernel), n_fft)[:grid_size]
+    density = np.clip(density, 0, None) / (len(values) * bandwidth * np.sqrt(2 * np.pi))
+    return (edges[:-1] + edges[1:]) / 2, density
+
+# ビン毎に集計したレコード数とKDEを描画する(KDEはヒストグラムのレコード数に合わせて拡大する)
+def plot_binned_histogram(ax, series):
+    values = finite_values(series)
+    counts, edges = np.histogram(values, bins=HIST_BINS)
+    ax.stairs(counts, edges, fill=True, alpha=0.6)
+    kde = binned_kde(values)
+    if kde is not None:
+        grid, density = kde
+        ax.plot(grid, density * len(values) * (edges[1] - edges[0]))
+
+##### 散布図
+# 六角形のビン毎のレコード数を、対数スケールの色で描画する
+def plot_hexbin(ax, x, y):
+    valid = x.notna().to_numpy() & y.notna().to_numpy()
+    collection = ax.hexbin(x.to_numpy(dtype=float, na_value=np.nan)[valid], y.to_numpy(dtype=float, na_value=np.nan)[valid],
+                           gridsize=HEXBIN_GRIDSIZE, bins='log', mincnt=1, cmap='viridis')
+    ax.figure.colorbar(collection, ax=ax, label='レコード数')
@@ -0,0 +1,113 @@
+import os
+import re
+import json
+import time
+import hashlib
+import unicodedata
+from pathlib import Path
+import functions.atomic_files as af
+
+##############################
+#
+# Chatbotのコード生成結果のキャッシュ
+# (分析内容を正規化したもの, カラムの一覧, 会話の履歴のハッシュ値, モデル)をキーとして、生成したコードをディスクに保存する
+# 同じ条件で同じ分析内容が入力された場合(別セッションを含む)は、APIを呼び出さずに保存したコードを返す
+# 保存するのは実行に成功したコードのみ(保存・削除の判定はfunc_chatbot.update_cacheで行う)
+#
+##############################
+
+# キャッシュの保存先(環境変数で変更可能)
+CACHE_DIR = Path(os.environ.get("VIRTUAL_ANALYST_LLM_CACHE_DIR", ".cache/llm_responses"))
+# キャッシュ全体の容量の上限(byte)
+MAX_CACHE_BYTES = int(os.environ.get("VIRTUAL_ANALYST_LLM_CACHE_MAX_BYTES", 100 * 1024**2))
+# キャッシュの保持期間(秒, 作成してからの期間)
+MAX_CACHE_AGE_SECONDS = int(os.environ.get("VIRTUAL_ANALYST_LLM_CACHE_MAX_AGE", 7 * 24 * 60 * 60))
+# プロンプトの形式のバージョン(プロンプトの内容を変更した場合は値を変更し、変更前に生成したコードを使用しないようにする)
+PROMPT_VERSION = 1
+
+##### キャッシュのキー
+# 分析内容を正規化する(全角・半角の統一、連続する空白の除去)
+# カラム名は大文字・小文字を区別するため、英字の大文字・小文字は統一しない
+def normalize_query(text):
+    text = unicodedata.normalize('NFKC', text)
+    return re.sub(r'\s+', ' ', text).strip()
+
+# 会話の履歴(プロンプトに含めるメッセージ)のハッシュ値
+def history_digest(messages):
+    state = [(message['role'], message['content']) for message in messages]
+    return hashlib.sha256(json.dumps(state, ensure_ascii=False, default=str).encode()).hexdigest()
+
+# LLMのモデル名(スタブなどモデル名を持たない場合はクラス名)
+def model_name(llm):
+    return getattr(llm, 'model_name', type(llm).__name__)
+
+# キャッシュのキーを作成する
+# kind: 生成の種類('generate'・'regenerate'), fields: キーに含める値(JSONに変換できるもの)
+def cache_key(kind, fields):
+    state = {'kind': kind, 'prompt_version': PROMPT_VERSION, **fields}
+    return hashlib.sha256(json.dumps(state, ensure_ascii=False, sort_keys=True, default=str).encode()).hexdigest()
+
+def cache_path(key):
+    return CACHE_DIR / f"{key}.json"
+
+##### キャッシュの読み書き
+# キャッシュが存在すれば生成したコードを返す(存在しない・保持期間を過ぎた場合はNone)
+def load_cached(key):
+    path = cache_path(key)
+    try:
+        entry = json.loads(path.read_text(encoding='utf-8'))
+        created, response = entry['created'], entry['response']
+        expired = time.time() - created > MAX_CACHE_AGE_SECONDS
+    except (OSError, ValueError):
+        return None
+    except (KeyError, TypeError):
+        # 形式が異なる・壊れたキャッシュは削除して、生成し直す
+        path.unlink(missing_ok=True)
+        return None
+    if expired:
+        path.unlink(missing_ok=True)
+        return None
+    # 最終アクセス日時を更新し、削除の優先度を下げる
+    os.utime(path)
+    return response
+
+# 生成したコードをキャッシュに書き込み、上限を超えた古いキャッシュを削除する
+def save_cache(key, response):
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    path = cache_path(key)
+    # 書き込み途中のファイルを他のセッションが読み込まないよう、一時ファイルに書き込んでから置き換える
+    try:
+        with af.atomic_path(path) as tmp_path:
+            tmp_path.write_text(json.dumps({'created': time.time(), 'response': response}, ensure_ascii=False), encoding='utf-8')
+    except OSError:
+        return
+    evict_cache()
+
+# キャッシュを削除する(キャッシュから取得したコードの実行に失敗した場合)
+def delete_cache(key):
+    cache_path(key).unlink(missing_ok=True)
+
+# 保持期間を過ぎたキャッシュと、容量の上限を超えた分のキャッシュを、最後に使用した日時が古い順に削除する
+# (中断された書き込みの一時ファイルも削除する)
+def evict_cache(max_bytes=MAX_CACHE_BYTES, max_age=MAX_CACHE_AGE_SECONDS):
+    if not CACHE_DIR.exists():
+        return
+    af.evict_tmp_files(CACHE_DIR)
+    now = time.time()
+    entries = []
+    for path in CACHE_DIR.glob("*.json"):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue # 他のセッションが削除済み
+        if now - stat.st_mtime > max_age:
+            path.unlink(missing_ok=True)
+        else:
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        path.unlink(missing_ok=True)
+        total_bytes -= size
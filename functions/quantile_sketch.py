@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+
+##############################
+#
+# 中央値・四分位数を近似計算するための、マージ可能な分位点スケッチ(DDSketch方式)
+# 値を対数スケールのバケット(代表値と元の値の相対誤差がrelative_accuracy以下)に割り当て、バケット毎のレコード数のみを保持する
+# レコード数は足し合わせることができるため、時間単位・カテゴリ単位などで作成したスケッチを後から粗い単位にまとめられる
+# (グループ毎に値を並べ替える必要が無く、分位点の相対誤差はrelative_accuracy以下となる)
+#
+##############################
+
+# 近似計算時の相対誤差の既定値
+DEFAULT_RELATIVE_ACCURACY = 0.01
+# スケッチのカラム名(バケットの代表値, レコード数)
+VALUE_LABEL = 'value'
+COUNT_LABEL = 'rows'
+
+##### スケッチの作成
+# 値をバケットの代表値に変換する(0・欠損値はそのまま)
+def bucket_values(series, relative_accuracy):
+    values = series.to_numpy(dtype=float, na_value=np.nan)
+    gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+    magnitude = np.abs(values)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        index = np.ceil(np.log(magnitude) / np.log(gamma))
+        representative = 2 * gamma**index / (gamma + 1)
+    return np.where(magnitude > 0, np.sign(values) * representative, values)
+
+# 集計キーの組み合わせ・バケット毎のレコード数を集計する
+# 集計対象が欠損値の行も代表値を欠損値として数える(「その他」に丸める際の割合の算出に使用できるようにする)
+# keys: 集計キー(Seriesのリスト)
+def build_sketch(keys, series, relative_accuracy):
+    value = pd.Series(bucket_values(series, relative_accuracy), index=series.index, name=VALUE_LABEL)
+    sketch = value.groupby(list(keys) + [value], dropna=False, observed=True, sort=False).size()
+    return sketch.rename(COUNT_LABEL).reset_index()
+
+##### 分位点の算出
+# スケッチを集計キーの組み合わせ毎にまとめ(バケット毎のレコード数を足し合わせる)、分位点を算出する
+# 集計キー・代表値が欠損値の行は除外する
+# keys: スケッチの各行に対応する集計キー(Seriesのリスト), q: 分位(0~1)またはそのリスト
+# 戻り値: 集計キーの組み合わせ → 分位点(qがリストの場合は分位毎のカラムを持つDataFrame)
+def sketch_quantile(sketch, keys, q):
+    merged = sketch.groupby(list(keys) + [sketch[VALUE_LABEL]], observed=True)[COUNT_LABEL].sum()
+    merged = merged[merged > 0]
+    levels = list(range(len(keys)))
+    cumulative = merged.groupby(level=levels, observed=True).cumsum()
+    total = merged.groupby(level=levels, observed=True).transform('sum')
+
+    results = {}
+    for quantile in np.atleast_1d(q):
+        # 累積のレコード数が順位(0始まり)を初めて超えるバケットの代表値を分位点とする
+        hit = merged[cumulative > quantile * (total - 1)].groupby(level=levels, observed=True).head(1)
+        results[quantile] = pd.Series(hit.index.get_level_values(-1), index=hit.index.droplevel(-1))
+    if np.ndim(q) == 0:
+        return results[q]
+    return pd.DataFrame(results)
@@ -0,0 +1,87 @@
+import streamlit as st
+import pandas as pd
+import functions.data_version as dv
+import functions.quantile_sketch as qs
+
+##############################
+#
+# 3変数の集計で使用するロールアップキューブ
+# ディメンションのカラム(文字列型は要素のまま・日付型は時間単位に丸めたもの)の組み合わせ(セル)毎に、
+# 数値型のカラムの合計・件数・最小値・最大値・レコード数を、(ディメンション, 集計対象のカラム)の組み合わせ毎に1度だけ集計する
+# 集計方法・「その他」に丸める閾値・日付の粒度を変更した場合は、元データではなくキューブを集計し直す
+# 中央値の近似計算を行う場合は、セル毎の分位点スケッチ(functions/quantile_sketch.py)を同様に作成・キャッシュする
+#
+##############################
+
+# キューブ・スケッチをキャッシュする容量の上限(byte)
+CUBE_CACHE_MAX_BYTES = 256 * 1024**2
+
+# セルをまとめる際の集計方法(キューブの集計値 → pandasの集計関数)
+MEASURES = {'sum': 'sum', 'count': 'sum', 'min': 'min', 'max': 'max', 'rows': 'sum'}
+# キューブから算出できる集計方法(画面上の集計方法の名称 → 算出方法)
+# 中央値はセルの集計値から算出できないため、元データまたはスケッチから集計する
+CUBE_AGGS = {
+    '合計': lambda cells: cells['sum'],
+    'カウント': lambda cells: cells['count'],
+    '平均': lambda cells: cells['sum'] / cells['count'],
+    '最大値': lambda cells: cells['max'],
+    '最小値': lambda cells: cells['min'],
+}
+
+##### キューブの作成
+# ディメンションのカラムをキューブのセルの単位に変換する(日付型は時間単位に丸める)
+def cube_dimension(series):
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series.dt.floor('h')
+    return series
+
+# セル毎の集計値を算出する
+# ディメンションが欠損値の行もセルとして残し、「その他」に丸める際の割合の算出に使用できるようにする
+def build_cube(df, dimensions, col_numeric):
+    keys = [cube_dimension(df[column]) for column in dimensions]
+    grouped = df[col_numeric].groupby(keys, dropna=False, observed=True, sort=False)
+    cube = grouped.agg(['sum', 'count', 'min', 'max', 'size'])
+    return cube.rename(columns={'size': 'rows'}).reset_index()
+
+# キューブ・スケッチをキャッシュから取得する(存在しない場合はbuildで作成してキャッシュに追加)
+# 分析用のデータ(st.session_state.df)の場合のみ、データの状態を表すキーでキャッシュする
+def get_cached(df, key, build):
+    if df is not st.session_state.get('df'):
+        return build()
+
+    cache = st.session_state.setdefault('rollup_cubes', {})
+    key = (dv.version_key(),) + key
+    if key in cache:
+        # 最近使用したものとして末尾に移動
+        cache[key] = cache.pop(key)
+        return cache[key][0]
+
+    table = build()
+    nbytes = int(table.memory_usage(deep=True).sum())
+    # 1つで容量の上限を超えるものはキャッシュしない
+    if nbytes <= CUBE_CACHE_MAX_BYTES:
+        cache[key] = (table, nbytes)
+        # 容量の上限を超えた場合は、使用されていない期間が長いものから削除
+        while sum(size for _, size in cache.values()) > CUBE_CACHE_MAX_BYTES:
+            cache.pop(next(iter(cache)))
+    return table
+
+# キューブを取得する
+def get_cube(df, dimensions, col_numeric):
+    dimensions = tuple(dimensions)
+    return get_cached(df, ('cube', dimensions, col_numeric),
+                      lambda: build_cube(df, dimensions, col_numeric))
+
+# 中央値・四分位数の近似計算に使用するスケッチ(セル・バケット毎のレコード数)を取得する
+def get_sketch(df, dimensions, col_numeric, relative_accuracy):
+    dimensions = tuple(dimensions)
+    return get_cached(df, ('sketch', dimensions, col_numeric, relative_accuracy),
+                      lambda: qs.build_sketch([cube_dimension(df[column]) for column in dimensions],
+                                              df[col_numeric], relative_accuracy))
+
+##### キューブの集計
+# キューブのセルを集計キーの組み合わせ毎にまとめ、集計方法に応じた値を算出する(集計キーが欠損値のセルは除外する)
+# keys: キューブの各セルに対応する集計キー(Seriesのリスト)
+def rollup(cube, keys, agg_type):
+    cells = cube.groupby(keys, observed=True)[list(MEASURES)].agg(MEASURES)
+    return CUBE_AGGS[agg_type](cells)
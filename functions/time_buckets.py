@@ -0,0 +1,85 @@
+import functions.func_aggregation as fag
+import functions.rollup_cube as rc
+import functions.quantile_sketch as qs
+
+##############################
+#
+# 日付カラムの粒度(月・週・日・時間)ごとの集計を行う
+# 合計・平均・カウントなどは、日付カラムを時間単位に丸めたロールアップキューブ(functions/rollup_cube.py)から
+# 粗い粒度の集計を算出する(粒度を切り替えても元データは再集計しない)
+#
+##############################
+
+# 日付カラムの粒度 → resampleの頻度(期間の終端の日付で集計)・期間(期間の開始日時で集計)・
+#                    resampleのラベルの単位(期間の終端をこの単位に丸めたものがラベルとなる)・表示形式
+TIME_BUCKETS = {
+    '月': {'resample': 'ME', 'period': 'M', 'label': 'D', 'format': '%Y-%m'},
+    '週': {'resample': 'W', 'period': 'W', 'label': 'D', 'format': '%Y-%m-%d'},
+    '日': {'resample': 'D', 'period': 'D', 'label': 'D', 'format': '%Y-%m-%d'},
+    '時間': {'resample': 'h', 'period': 'h', 'label': 'h', 'format': '%m-%d %H'},
+}
+# カテゴリのカラムを集計キーに加える場合のカラム名
+CATEGORY_LABEL = 'カテゴリ'
+
+##### 日付の丸め・表示
+# 日付を粒度ごとの期間の開始日時に丸める
+def floor_datetime(series, datetime_type):
+    return series.dt.to_period(TIME_BUCKETS[datetime_type]['period']).dt.to_timestamp()
+
+# 日付をresampleと同じ期間の終端のラベルに変換する
+def resample_label(series, datetime_type):
+    bucket = TIME_BUCKETS[datetime_type]
+    return series.dt.to_period(bucket['period']).dt.to_timestamp(how='end').dt.floor(bucket['label'])
+
+# 集計結果の日付を表示用の文字列に変換する
+def format_datetime(series, datetime_type):
+    return series.dt.strftime(TIME_BUCKETS[datetime_type]['format'])
+
+##### 集計キーの作成
+# 日付カラム(指定した粒度に丸めたもの)と、カテゴリのカラム(「その他」に丸めたもの)を集計キーとして返す
+# datetime_types: 日付カラム名 → 粒度, category: (カテゴリのカラム名, 閾値) またはNone
+# weights: 各行が表すレコード数(キューブから集計キーを作成する場合に指定する)
+def group_keys(df, datetime_types, category=None, weights=None):
+    keys = [floor_datetime(df[column], datetime_type) for column, datetime_type in datetime_types.items()]
+    if category is not None:
+        column, threshold = category
+        _, bucketed = fag.bucket_categories(df[column], threshold, weights)
+        keys.append(bucketed.rename(CATEGORY_LABEL))
+    return keys
+
+##### 粒度ごとの集計
+# relative_accuracyを指定した場合、中央値はスケッチから近似計算する(相対誤差はrelative_accuracy以下)
+
+# 1つの日付カラムに対する時系列の集計(resampleと同様に、データが存在しない期間も含めて期間の終端の日付で集計する)
+def aggregate_timeline(df, col_datetime, col_numeric, datetime_type, agg_type, relative_accuracy=None):
+    freq = TIME_BUCKETS[datetime_type]['resample']
+    if agg_type in rc.CUBE_AGGS:
+        cube = rc.get_cube(df, [col_datetime], col_numeric)
+        cells = cube.dropna(subset=[col_datetime]).set_index(col_datetime).sort_index()
+        agg_series = rc.CUBE_AGGS[agg_type](cells[list(rc.MEASURES)].resample(freq).agg(rc.MEASURES))
+    elif agg_type == '中央値' and relative_accuracy is not None:
+        sketch = rc.get_sketch(df, [col_datetime], col_numeric, relative_accuracy).dropna(subset=[col_datetime])
+        # データが存在しない期間も含めたラベルの一覧
+        labels = sketch.set_index(col_datetime)[qs.COUNT_LABEL].sort_index().resample(freq).sum().index
+        keys = [resample_label(sketch[col_datetime], datetime_type)]
+        agg_series = qs.sketch_quantile(sketch, keys, 0.5).reindex(labels)
+    else:
+        # 中央値などはキューブから算出できないため、元データから集計する
+        agg_series = df.set_index(col_datetime)[col_numeric].resample(freq).agg(fag.AGG_FUNCS[agg_type])
+    return agg_series.rename(col_numeric).rename_axis(col_datetime).reset_index()
+
+# 日付カラム(1つ以上)とカテゴリのカラムの組み合わせ毎の集計(データが存在する組み合わせのみ、期間の開始日時で集計する)
+def aggregate_grouped(df, datetime_types, col_numeric, agg_type, category=None, relative_accuracy=None):
+    dimensions = list(datetime_types) + ([category[0]] if category is not None else [])
+    if agg_type in rc.CUBE_AGGS:
+        cube = rc.get_cube(df, dimensions, col_numeric)
+        keys = group_keys(cube, datetime_types, category, weights=cube['rows'])
+        agg_series = rc.rollup(cube, keys, agg_type)
+    elif agg_type == '中央値' and relative_accuracy is not None:
+        sketch = rc.get_sketch(df, dimensions, col_numeric, relative_accuracy)
+        keys = group_keys(sketch, datetime_types, category, weights=sketch[qs.COUNT_LABEL])
+        agg_series = qs.sketch_quantile(sketch, keys, 0.5)
+    else:
+        keys = group_keys(df, datetime_types, category)
+        agg_series = df[col_numeric].groupby(keys, observed=True).agg(fag.AGG_FUNCS[agg_type])
+    return agg_series.rename(col_numeric).reset_index()
@@ -1,6 +1,8 @@
 import streamlit as st
+import pandas as pd
 from functions.multi_pages import multi_page
 from functions.func_chatbot import use_secret
+import functions.data_summary as ds
  
 # 環境変数が設定されていない場合、以下のコマンドを実行する必要がある
 # python -m streamlit run .\streamlit_app.py
@@ -14,6 +16,10 @@ st.set_page_config(
     layout="wide",
     initial_sidebar_state="auto"
 )
+# pandasのCopy-on-Writeを有効にする(サーバープロセス全体の設定のため、ここで1度だけ設定する)
+# 分析用のデータは元データとメモリを共有した浅いコピーとして作成するため、各ページでの変更が元データに反映されないようにする
+# (コードの実行はワーカープロセスで行い、code_workers.executeで個別に有効にする)
+pd.set_option("mode.copy_on_write", True)
 
 ###########################
 # サイドバーの設定
@@ -32,8 +38,9 @@ st.title("Webアプリの説明")
 st.divider()
 ## dfがセッションステートに保存されており、かつ空のファイルではない場合
 if 'df' in st.session_state and st.session_state.df is not None:
-    st.write(f"アップロードした以下のデータに対して分析を実施中です(データサイズ: {st.session_state.df.shape})")
-    st.dataframe(st.session_state.df.head())
+    summary = ds.get_summary()
+    st.write(f"アップロードした以下のデータに対して分析を実施中です(データサイズ: {summary['shape']})")
+    st.dataframe(summary['head'])
 
 st.header("📁csvアップロード")
 st.markdown("- このページから、分析に使用するデータをcsv形式でアップロードしてください")
@@ -4,6 +4,10 @@ from functions.multi_pages import multi_page
 import functions.func_base_analysis as fba
 import functions.error_messages as em
 import functions.download_files as download_files
+import functions.data_summary as ds
+import functions.quantile_sketch as qs
+import functions.large_plots as lp
+import functions.figure_cache as fc
 
 ###########################
 # ページの設定
@@ -19,6 +23,33 @@ st.set_page_config(
 # サイドバーの設定
 ###########################
 multi_page()
+# 大規模データ向けに、中央値・四分位数を近似計算する・描画を簡略化する設定
+with st.sidebar:
+    with st.expander("集計・描画の設定"):
+        approx_quantile = st.toggle(
+            "中央値・四分位数を近似計算する",
+            help="グループ毎に値を並べ替えずに、指定した相対誤差以内の近似値を算出します(大規模データ向け)",
+            key="approx_quantile"
+        )
+        approx_accuracy = st.number_input(
+            "近似計算時の相対誤差(単位: %)",
+            min_value=0.1,
+            max_value=10.0,
+            value=qs.DEFAULT_RELATIVE_ACCURACY*100,
+            step=0.5,
+            key="approx_accuracy",
+            disabled=not approx_quantile
+        )
+        downsample_threshold = st.number_input(
+            "ヒストグラム・散布図を簡略化して描画する行数の閾値",
+            help="行数がこの値を超える場合は、全ての行を描画せずにビン毎に集計したレコード数を描画します",
+            min_value=1000,
+            value=lp.DEFAULT_THRESHOLD,
+            step=10000,
+            key="downsample_threshold"
+        )
+# 近似計算を行わない場合はNone
+relative_accuracy = approx_accuracy/100 if approx_quantile else None
 
 ###########################
 # コンテンツ
@@ -36,6 +67,8 @@ else:
          "2変数(文字列型×文字列型)",
          "3変数(クロス集計)"]
     tab_list = st.tabs(tab_names)
+    # データの概要はデータの状態毎に1度だけ集計したものを使用する
+    summary = ds.get_summary()
 
     ##### データの概要を出力するタブ
     with tab_list[0]:
@@ -44,13 +77,9 @@ else:
             st.header("基本情報")
             st.divider()
             # 行数と列数を出力
-            st.write("データの行数・列数", st.session_state.df.shape)
-            # 型と欠損値を直接取得
-            df_tmp_1 = st.session_state.df.dtypes
-            df_tmp_1.columns = ['カラム名', 'データ型']
-            df_tmp_2 = st.session_state.df.isnull().sum()
-            df_tmp_2.columns = ['カラム名', '欠損レコード数']
-            df_summary = pd.concat([df_tmp_1, df_tmp_2], axis=1)
+            st.write("データの行数・列数", summary['shape'])
+            # 型と欠損値を取得
+            df_summary = summary['dtypes']
             # 出力用にデータを加工
             column_config = {
                 # 割合を0~100%に対する比率で表示
@@ -65,9 +94,9 @@ else:
             st.header("データの概要")
             st.divider()
             st.markdown("冒頭の5行")
-            st.write(st.session_state.df.head())
+            st.write(summary['head'])
             st.markdown("末尾の5行")
-            st.write(st.session_state.df.tail())
+            st.write(summary['tail'])
 
     ##### 1変数の統計量を出力するタブ
     with tab_list[1]:
@@ -76,11 +105,11 @@ else:
         # describe関数の実行結果を出力
         st.markdown("### 数値型, 日付型の変数のサマリ")
         if em.coltype_error("数値型") or em.coltype_error("日付型"):
-            st.write(st.session_state.df.describe(exclude="object"))
+            st.write(summary['describe_numeric'])
 
         st.markdown("### 文字列型の変数のサマリ")
         if em.coltype_error("文字列型"):
-            st.write(st.session_state.df.describe(include="object"))
+            st.write(summary['describe_object'])
 
         # 数値型に対してはヒストグラムを描画
         st.markdown("### 特定変数の分布")
@@ -93,8 +122,7 @@ else:
                     st.session_state.numeric_columns,
                     key="numeric_column_tab1"
                 )
-                fig_hist = fba.histogram(st.session_state.df, selected_numeric_column)
-                st.pyplot(fig_hist, clear_figure=False)
+                fc.render(fba.histogram, st.session_state.df, selected_numeric_column, downsample_threshold)
             
             plot_tab1_histogram()
 
@@ -128,9 +156,7 @@ else:
             st.markdown("### 相関行列")
             @st.fragment
             def plot_tab2_heatmap():
-                filtered_df = st.session_state.df[st.session_state.numeric_columns]
-                fig_corr = fba.plot_correlation_heatmap(filtered_df)
-                st.pyplot(fig_corr, clear_figure=False)
+                fc.render(fba.plot_correlation_heatmap, st.session_state.df, st.session_state.numeric_columns)
 
             plot_tab2_heatmap()
 
@@ -149,8 +175,7 @@ else:
                     key="numeric_column_tab2_1"
                 )
                 if col1 and col2:
-                    fig_scatter = fba.plot_scatter(st.session_state.df, col1, col2)
-                    st.pyplot(fig_scatter, clear_figure=False)
+                    fc.render(fba.plot_scatter, st.session_state.df, col1, col2, downsample_threshold)
 
             plot_tab2_scatter()
 
@@ -216,14 +241,13 @@ else:
                     with col_right:   
                         if col1 and col2:
                             st.markdown("#### 箱ひげ図による分布の比較")
-                            fig_box = fba.plot_box(st.session_state.df, col1, col2, threshold/100)
-                            st.pyplot(fig_box, clear_figure=False)
+                            fc.render(fba.plot_box, st.session_state.df, col1, col2, threshold/100, relative_accuracy)
 
                     # 文字列型に対して、数値型の基礎統計量を集計
                     st.markdown(f"### {col1}カラムの要素に対する{col2}の集計")
 
                     # 計算処理
-                    result = fba.agg_1parameter(st.session_state.df, col1, col2, threshold/100)
+                    result = fba.agg_1parameter(st.session_state.df, col1, col2, threshold/100, relative_accuracy)
                     st.write(result)
 
                 plot_tab3_0_box()
@@ -259,14 +283,13 @@ else:
                     # 描画の実施
                     st.markdown(f"### {datetime_type}単位での{col2}の{agg_type}の推移")
                     # 必要なデータを集計
-                    agg_df = fba.agg_datetime_dataframe(st.session_state.df, datetime_type, agg_type, col1, col2)
+                    agg_df = fba.agg_datetime_dataframe(st.session_state.df, datetime_type, agg_type, col1, col2, relative_accuracy)
                     plot_type = st.selectbox(
                         "描画方法を選択してください",
                         ["棒グラフ", "折れ線グラフ"],
                         key="plot_type"
                     )
-                    fig_datetime_1param = fba.plot_datetime_1param(agg_df, col1, col2, plot_type, datetime_type)
-                    st.pyplot(fig_datetime_1param, clear_figure=False)
+                    fc.render(fba.plot_datetime_1param, agg_df, col1, col2, plot_type, datetime_type)
                     st.markdown("### 描画に使ったデータの確認")
                     st.dataframe(agg_df)
 
@@ -296,13 +319,11 @@ else:
                 if col1 and col2:
                     # ヒートマップを描画
                     st.markdown("### 2カラム選定時のクロス集計表")
-                    fig_cross_heatmap = fba.plot_cross_heatmap(st.session_state.df, col1, col2)
-                    st.pyplot(fig_cross_heatmap, clear_figure=False)
+                    fc.render(fba.plot_cross_heatmap, st.session_state.df, col1, col2)
                     # 積み上げ棒グラフを描画
                     st.markdown("### 2カラム選定時の積み上げ棒グラフ")
                     normalize = st.checkbox('実数ではなく割合で描画する', value=False)
-                    fig_cross_bar = fba.plot_cross_bar(st.session_state.df, col1, col2, normalize)
-                    st.pyplot(fig_cross_bar, clear_figure=False)
+                    fc.render(fba.plot_cross_bar, st.session_state.df, col1, col2, normalize)
 
             plot_tab4_crosstab()
 
@@ -397,13 +418,13 @@ else:
                     if col_dim1 in st.session_state.datetime_columns and\
                     col_dim2 in st.session_state.datetime_columns:
                         agg_df = fba.agg_datetime_2col_dataframe(st.session_state.df, datetime_type1, datetime_type2,
-                                                        agg_type, col_dim1, col_dim2, col_numeric)
+                                                        agg_type, col_dim1, col_dim2, col_numeric, relative_accuracy)
                         st.dataframe(agg_df)
                     # ディメンションが共に文字列型データ
                     elif col_dim1 in st.session_state.non_numeric_columns and\
                     col_dim2 in st.session_state.non_numeric_columns:
                         agg_df = fba.agg_category_2col_dataframe(st.session_state.df, col_dim1, col_dim2, col_numeric,
-                                                        agg_type, threshold1/100, threshold2/100)
+                                                        agg_type, threshold1/100, threshold2/100, relative_accuracy)
                         st.dataframe(agg_df)
                     # ディメンションが文字列・日付型の複合
                     else:
@@ -419,7 +440,7 @@ else:
                             col_datetime = col_dim1
                             datetime_type_input = datetime_type1
                         agg_df = fba.agg_category_datetime_dataframe(st.session_state.df, col_category, col_datetime, col_numeric,
-                                                        agg_type, threshold_input/100, datetime_type_input)
+                                                        agg_type, threshold_input/100, datetime_type_input, relative_accuracy)
                         st.dataframe(agg_df)
                 # 時系列グラフ
                 elif plot_type == "時系列グラフ" and col_dim1 != col_dim2:
@@ -453,10 +474,9 @@ else:
                             datetime_type2 = datetime_type_tmp
                         # agg_dfのindex→col_dim1, column→col_dim2となる
                         agg_df = fba.agg_datetime_2col_dataframe(st.session_state.df, datetime_type1, datetime_type2,
-                                                        agg_type, col_dim1, col_dim2, col_numeric)
-                        fig = fba.plot_date_category_3val(agg_df, col_numeric, col_dim1, col_dim2,
-                                                          agg_type, plot_type, plot_agg_type1, plot_agg_type2)
-                        st.pyplot(fig, clear_figure=False)
+                                                        agg_type, col_dim1, col_dim2, col_numeric, relative_accuracy)
+                        fc.render(fba.plot_date_category_3val, agg_df, col_numeric, col_dim1, col_dim2,
+                                  agg_type, plot_type, plot_agg_type1, plot_agg_type2)
                         st.dataframe(agg_df)
                     # ディメンションが文字列・日付型の複合
                     else:
@@ -472,10 +492,9 @@ else:
                             col_datetime = col_dim1
                             datetime_type_input = datetime_type1
                         agg_df = fba.agg_category_datetime_dataframe(st.session_state.df, col_category, col_datetime, col_numeric,
-                                                        agg_type, threshold_input/100, datetime_type_input)
-                        fig = fba.plot_date_category_3val(agg_df, col_numeric, col_datetime, col_category,
-                                                          agg_type, plot_type, plot_agg_type1, plot_agg_type2)
-                        st.pyplot(fig, clear_figure=False)
+                                                        agg_type, threshold_input/100, datetime_type_input, relative_accuracy)
+                        fc.render(fba.plot_date_category_3val, agg_df, col_numeric, col_datetime, col_category,
+                                  agg_type, plot_type, plot_agg_type1, plot_agg_type2)
                         st.dataframe(agg_df)
 
             plot_tab5_timeline()
@@ -2,6 +2,8 @@ import streamlit as st
 import pandas as pd
 from functions.multi_pages import multi_page
 import functions.error_messages as em
+import functions.data_version as dv
+import functions.func_change_datatype as fcd
 
 ###########################
 # ページの設定
@@ -28,28 +30,32 @@ if 'df' not in st.session_state or st.session_state.df is None:
     st.write("CSVファイルをアップロードしてください。")
 # dfが存在する場合は型変換を実行
 else:
-    st.write(":red[変換できない型を指定すると、そのカラムがnullになってしまうので注意してください]")
-    st.write("その場合、ファイルの再アップロードが必要になります")
-
-    # 型変換を行う関数を作成し、キャッシュ化
-    @st.cache_data
-    def convert_column_type(df, column, new_type):
-        if new_type == "数値型":
-            df[column] = pd.to_numeric(df[column], errors='coerce')
-        elif new_type == "文字列型":
-            df[column] = df[column].astype('string')
-        elif new_type == "日付型":
-            df[column] = pd.to_datetime(df[column], errors='coerce')
-        return df
+    st.write(":red[変換できない値はnullになってしまうので注意してください]")
+    st.write("全ての値が変換できない型を指定した場合は、変換を行わずにエラーを表示します")
 
+    # カラム毎に変換後の型を選択し、未適用の変換のみをまとめて実行する
+    # (DataFrame全体のハッシュ化や、変換済みのカラムの再変換は行わない)
+    requested = {}
     for column in st.session_state.df.columns:
         new_type = st.selectbox(f"{column} の新しいデータ型を選択してください(現状の型: {st.session_state.df[column].dtypes})", 
                                 options=["そのまま", "数値型", "文字列型", "日付型"], 
                                 index=0)
-        # filter機能をリセットした際にカラムの型が元に戻らないように、df_originalも変換する
         if new_type != "そのまま":
-            st.session_state.df = convert_column_type(st.session_state.df, column, new_type)
-            st.session_state.df_original = convert_column_type(st.session_state.df_original, column, new_type)
+            requested[column] = new_type
+    # 元データ(df_original)のカラムを1度だけ変換し、分析用のデータ(df)はそこから作り直す
+    # (filter機能をリセットした際にもカラムの型が元に戻らない)
+    conversion_report = fcd.apply_conversions(requested)
+    if conversion_report:
+        st.session_state.conversion_report = conversion_report
+
+    # 変換できなかった値がある場合は、件数と値の例を表示する
+    for column, result in st.session_state.get('conversion_report', {}).items():
+        if not result['applied']:
+            st.error(f"{column} カラムの値を{result['new_type']}に変換できなかったため、変換を行いませんでした。"
+                     f"(値の例: {result['failed_examples']})", icon=":material/error:")
+        elif result['n_failed'] > 0:
+            st.warning(f"{column} カラムの{result['n_failed']}件の値を{result['new_type']}に変換できなかったため、nullになりました。"
+                       f"(値の例: {result['failed_examples']})", icon=":material/warning:")
 
     # 不適切な変換についてはアラートを出す
     em.all_null_warning("数値型")
@@ -60,15 +66,7 @@ else:
     st.write(st.session_state.df)
 
     # カラム名を保存
-    # 数値型のカラム名のリスト
-    st.session_state.numeric_columns_original = st.session_state.df.select_dtypes(include=['number']).columns.tolist()
-    st.session_state.numeric_columns = st.session_state.df.select_dtypes(include=['number']).columns.tolist()
-    # 日付型のカラム名のリスト
-    st.session_state.datetime_columns_original = st.session_state.df.select_dtypes(include=['datetime']).columns.tolist()
-    st.session_state.datetime_columns = st.session_state.df.select_dtypes(include=['datetime']).columns.tolist()
-    # 文字列型のカラム名のリスト
-    st.session_state.non_numeric_columns_original = st.session_state.df.select_dtypes(exclude=['number', 'datetime']).columns.tolist()
-    st.session_state.non_numeric_columns = st.session_state.df.select_dtypes(exclude=['number', 'datetime']).columns.tolist()
+    dv.update_column_types(original=True)
 
     st.markdown("## 変換後のデータ型一覧:")
     st.write("数値型のカラム:", st.session_state.numeric_columns)
@@ -8,11 +8,13 @@ import traceback
 from langchain.chat_models import ChatOpenAI
 from langchain.prompts import PromptTemplate
 from langchain.chains import LLMChain
-from langchain_experimental.utilities import PythonREPL
 from langchain.agents import Tool
 
 from functions.multi_pages import multi_page
 import functions.func_chatbot as fc
+import functions.data_version as dv
+import functions.execution_snapshot as es
+import functions.code_workers as cw
 
 # 環境変数が設定されていない場合、以下のコマンドを実行する必要がある
 # python -m streamlit run .\streamlit_app.py
@@ -43,9 +45,18 @@ with st.expander("チャットの設定"):
     #summary_conversion = st.toggle("推論時に過去のチャットを要約する")
     summary_conversion = False # 要約すると上手く動かないためコメントアウト
     retry_num = st.number_input("エラー発生時のリトライ回数を入力してください", min_value=1, max_value=5, key="retry_num")
+    # 同じ分析内容でもキャッシュを使用せず、ChatGPTに問い合わせてコードを生成し直す
+    use_cache = not st.toggle("キャッシュを使用せずにコードを生成する", key="bypass_llm_cache")
 
 # チャットの開始(st.session_state.messagesの初期化)
 fc.init_messages(clear_conversation)
+# コードを実行するワーカーに、現在のデータを事前に読み込ませる
+cw.warm_up()
+
+# コード生成のリクエスト毎のトークン数を表示
+if st.session_state.token_usage:
+    with st.expander("トークン数の記録"):
+        st.dataframe(pd.DataFrame(st.session_state.token_usage), use_container_width=True)
 
 # --- カスタムCSSの追加 ---
 st.markdown(
@@ -111,8 +122,8 @@ with tab_list[0]:
 
         # 入力を受け付けた後、コードを生成&表示する
         with st.spinner("ChatGPTがコードを生成中です…"):
-            generated_code = fc.generate_code(user_input, summary_conversion)
-            st.session_state.messages.append({"role": "assistant", "content": generated_code})
+            generated_code = fc.generate_code(user_input, summary_conversion, use_cache=use_cache)
+            st.session_state.messages.append({"role": "assistant", "content": generated_code, "kind": "code"})
             with st.chat_message("assistant"):
                 st.write("**生成されたコード:**")
                 st.code(generated_code, language="python")
@@ -120,7 +131,7 @@ with tab_list[0]:
             # コード生成後、実行結果を表示する
             st.info("生成されたコードを実行中…")
             result = fc.execute_code(generated_code, user_input)
-            st.session_state.messages.append({"role": "assistant", "content": result})
+            st.session_state.messages.append({"role": "assistant", "content": result, "kind": "result"})
             with st.chat_message("assistant"):
                 st.write("**実行結果:**")
                 st.code(result, language="python")
@@ -132,14 +143,15 @@ with tab_list[0]:
                 user_input_error = f"正しく実行ができていないため、エラー内容をもとに自動でコードの修正を実施中 (再生成{attempt}回目)"
                 st.session_state.messages.append({
                     "role": "user",
-                    "content": user_input_error
+                    "content": user_input_error,
+                    "kind": "retry" # 会話の履歴を作成する際に、置き換えられたコード・エラーを除外するための目印
                 })
                 with st.chat_message("user"):
                     st.markdown(user_input_error)
 
                 # エラー内容をもとにコードの再生成
-                generated_code = fc.re_generate_code(generated_code, result, summary_conversion)
-                st.session_state.messages.append({"role": "assistant", "content": generated_code})
+                generated_code = fc.re_generate_code(generated_code, result, summary_conversion, use_cache=use_cache)
+                st.session_state.messages.append({"role": "assistant", "content": generated_code, "kind": "code"})
                 with st.chat_message("assistant"):
                     st.write(f"**生成されたコード (再生成{attempt}回目):**")
                     st.code(generated_code, language="python")
@@ -147,7 +159,7 @@ with tab_list[0]:
                 # 再生成したコードを実行
                 st.info("生成されたコードを実行中…")
                 result = fc.execute_code(generated_code, user_input_error)
-                st.session_state.messages.append({"role": "assistant", "content": result})
+                st.session_state.messages.append({"role": "assistant", "content": result, "kind": "result"})
                 with st.chat_message("assistant"):
                     st.write("**実行結果:**")
                     st.code(result, language="python")
@@ -159,12 +171,6 @@ with tab_list[0]:
                 st.error("自動実行でエラーが解消されなかったので、再度指示を入力してください")
 
 
-# 例：重い処理を分離するための関数（@st.fragment により UI の変更で再実行されなくなります）
-@st.fragment
-def run_heavy_code(code):
-    python_repl = PythonREPL()
-    python_repl.run(code)
-
 # 過去の実行履歴を表示
 with tab_list[1]:
     # タイトル用のカラムを用意
@@ -174,12 +180,12 @@ with tab_list[1]:
     with col2_title:
         st.write("**check**")
         
-    # 以前の実行結果を全て表示
+    # 以前の実行結果を全て表示(コードは再実行せず、実行時に記録したスナップショットを表示する)
     if "execution_results" in st.session_state:
         execution_results = st.session_state.execution_results
-        # 1-indexed で奇数番の結果（0番目, 2番目, …）をループ
-        for i in range(0, len(execution_results), 2):
-            num = int((i + 2) / 2)
+        current_version = dv.version_key() if st.session_state.df is not None else None
+        for i, execution in enumerate(execution_results):
+            num = i + 1
             # 各行ごとに新たにカラムを生成することで、縦方向の位置を揃える
             row_left, row_right = st.columns([0.9, 0.1])
             
@@ -190,13 +196,21 @@ with tab_list[1]:
                 exp = st.expander(f"実行結果 {num}", expanded=False)
                 with exp:
                     st.write("**プロンプト**")
-                    st.write(execution_results[i])
-                    # 次の偶数番の結果が存在する場合は合わせて表示
-                    if i + 1 < len(execution_results):
-                        st.write("**実行結果**")
-                        st.code(execution_results[i + 1])
-                        # 重い処理部分は関数 run_heavy_code に任せる（※st.fragment により再実行されません）
-                        run_heavy_code(execution_results[i + 1])
+                    st.write(execution['prompt'])
+                    st.write("**実行結果**")
+                    st.code(execution['code'])
+                    # コードの再実行はボタンが押された場合のみ行う(データが変更された場合はその旨を表示する)
+                    if execution['version'] != current_version:
+                        st.info("この実行結果は、現在とは異なるデータ(フィルタ・型変換など)で実行したものです", icon=":material/info:")
+                    if st.button("現在のデータで再実行する", key=f"rerun_{i}"):
+                        with st.spinner("コードを再実行中…"):
+                            fc.rerun_execution(execution)
+                    # 実行時(再実行時)にエラーが発生した場合は、エラーの内容を表示する
+                    if "Error" in execution.get('output', ''):
+                        st.error("Error:\n" + execution['output'])
+                    if execution.get('trimmed'):
+                        st.info("実行履歴の容量の上限を超えたため、この実行結果の表示内容は削除されました。再実行すると表示されます", icon=":material/info:")
+                    es.render(execution['elements'])
                 st.markdown("</div>", unsafe_allow_html=True)
                 
             with row_right:
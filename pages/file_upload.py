@@ -1,6 +1,9 @@
 import streamlit as st
 import pandas as pd
 from functions.multi_pages import multi_page
+import functions.func_file_upload as ffu
+import functions.data_cache as data_cache
+import functions.data_version as dv
 
 ###########################
 # ページの設定
@@ -26,30 +29,45 @@ if 'df' not in st.session_state:
 
 st.title("CSVファイルアップローダー")
 
-@st.cache_data
+# 読み込んだデータはdata_cacheでディスクにキャッシュするため、メモリ上にはキャッシュしない
 def load_data(uploaded_file):
     df = pd.read_csv(uploaded_file)
     return df
 
 uploaded_file = st.file_uploader("CSVファイルをアップロードしてください", type=["csv"])
+# 大容量ファイルはチャンク単位で読み込み、ピークメモリを抑える
+chunked_flag = st.toggle("大容量ファイルモード(分割して読み込む)", key="chunked_upload")
+# 数値型のビット幅の縮小・文字列型のカテゴリ型への変換を行い、メモリ使用量を削減する
+compact_flag = st.toggle("メモリ節約モード(データ型を圧縮する)", key="compact_upload")
 
 if uploaded_file is not None:
+    # 新しいファイルがアップロードされた場合のみ読み込む(同一ファイルでの再実行時は読み込み済みのデータを使用)
+    load_key = (uploaded_file.file_id, compact_flag)
+    if st.session_state.get("uploaded_file_id") != load_key:
+        # 同じ中身のファイルが過去にアップロードされていれば、CSVをパースせずにキャッシュから読み込む
+        dataset_key = data_cache.file_hash(uploaded_file)
+        df = data_cache.load_cached(dataset_key)
+        if df is None:
+            if chunked_flag:
+                df = ffu.load_data_chunked(uploaded_file)
+            else:
+                df = load_data(uploaded_file)
+            data_cache.save_cache(dataset_key, df)
+        # キャッシュには元のデータ型のまま保存し、圧縮は読み込み後に行う
+        st.session_state.compact_report = None
+        if compact_flag:
+            df, st.session_state.compact_report = ffu.compact_dtypes(df)
+        # データをセッションステートに保存(圧縮の有無でデータ型が異なるため、キーを分ける)
+        dv.init_dataset(df, dataset_key + ("-compact" if compact_flag else ""))
+        st.session_state.uploaded_file_id = load_key
+    df = st.session_state.df_original
+
+    # データ型の圧縮結果を表示
+    if st.session_state.compact_report is not None:
+        report = st.session_state.compact_report
+        with st.expander(f"メモリ使用量: {report['変換前のメモリ(MB)'].sum():.1f}MB → {report['変換後のメモリ(MB)'].sum():.1f}MB"):
+            st.dataframe(report, column_config={"": st.column_config.TextColumn("カラム名")})
     # アップロード結果の可視化
-    df = load_data(uploaded_file)
     st.write("アップロードされたデータのサイズ:", df.shape)
     st.dataframe(df)
 
-    # データをセッションステートに保存
-    st.session_state.df_original = df # 生データ
-    st.session_state.df = df # 分析に使用するデータ(生データを使用するケースも想定してオブジェクトを分ける)
-
-    # カラム名を保存
-    # 数値型のカラム名のリスト
-    st.session_state.numeric_columns_original = st.session_state.df.select_dtypes(include=['number']).columns.tolist()
-    st.session_state.numeric_columns = st.session_state.df.select_dtypes(include=['number']).columns.tolist()
-    # 日付型のカラム名のリスト
-    st.session_state.datetime_columns_original = st.session_state.df.select_dtypes(include=['datetime']).columns.tolist()
-    st.session_state.datetime_columns = st.session_state.df.select_dtypes(include=['datetime']).columns.tolist()
-    # 文字列型のカラム名のリスト
-    st.session_state.non_numeric_columns_original = st.session_state.df.select_dtypes(exclude=['number', 'datetime']).columns.tolist()
-    st.session_state.non_numeric_columns = st.session_state.df.select_dtypes(exclude=['number', 'datetime']).columns.tolist()
\ No newline at end of file
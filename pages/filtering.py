@@ -1,6 +1,9 @@
 import streamlit as st
 import pandas as pd
 from functions.multi_pages import multi_page
+import functions.data_version as dv
+import functions.column_stats as cs
+import functions.download_files as download_files
 
 ###########################
 # ページの設定
@@ -48,55 +51,93 @@ else:
         st.markdown(button_css, unsafe_allow_html=True)
         reset_flag = st.button("フィルタをリセット", key="reset_button")
         if reset_flag:
-            # データそのものをリセット
-            st.session_state.df = st.session_state.df_original.copy()
-            # 対象カラムをリセット
-            st.session_state.numeric_columns = st.session_state.numeric_columns_original.copy()
-            st.session_state.datetime_columns = st.session_state.datetime_columns_original.copy()
-            st.session_state.non_numeric_columns = st.session_state.non_numeric_columns_original.copy()
+            # 元データをそのまま参照するため、データのコピーは発生しない
+            dv.reset()
+            # ウィジェットに残っている入力値も初期化する
+            for key in [key for key in st.session_state if str(key).startswith("filter_")]:
+                del st.session_state[key]
+
+        # フィルタの選択肢・範囲は元データを基に作成し、設定済みのフィルタ条件を初期値とする
+        df_original = st.session_state.df_original
+        filters = st.session_state.transforms['filters']
+        # 各カラムのユニーク数・最小値・最大値などは、データの状態毎に1度だけ集計したものを使用する
+        column_stats = cs.get_column_stats()
 
         # 使用するカラムを選択
         st.markdown("## 使用カラムの設定")
         selected_columns = st.multiselect(
             "分析に使用するカラムを選択してください",
-            options=st.session_state.df_original.columns,
-            default=st.session_state.df.columns
+            options=df_original.columns,
+            default=st.session_state.df.columns,
+            key="filter_columns"
         )
-
-        # 使用するカラムに基づいてsession_stateのデータ・カラムを更新する
-        st.session_state.df = st.session_state.df[selected_columns]
-        st.session_state.numeric_columns = st.session_state.df.select_dtypes(include=['number']).columns.tolist()
-        st.session_state.datetime_columns = st.session_state.df.select_dtypes(include=['datetime']).columns.tolist()
-        st.session_state.non_numeric_columns = st.session_state.df.select_dtypes(exclude=['number', 'datetime']).columns.tolist()
+        dv.set_columns(selected_columns)
+        # 使用しないカラムのフィルタ条件は解除する
+        for column in list(filters):
+            if column not in selected_columns:
+                dv.set_filter(column, None)
 
         # 各カラムごとにフィルタを作成
         st.markdown("## カラム別の範囲の指定")
-        for column in st.session_state.df.columns:
+        for column in selected_columns:
             st.markdown(f"### {column}の範囲の指定")
-            if st.session_state.df[column].dtype in ['object', 'string']:
-                unique_values = st.session_state.df[column].unique()
+            spec = filters.get(column)
+            stats = column_stats[column]
+            # メモリ節約モードで圧縮されたデータ型(カテゴリ型, int8など)・タイムゾーン付きの日付型も対象にするため、
+            # 統計量を集計した際のカラムの分類(functions/column_stats.py)に基づいて判定する
+            if stats['kind'] == 'category':
                 # 要素数が多い場合はフィルタ条件を直接入力する
-                if len(unique_values) > 10:
-                    user_input = st.text_input(f"{column} の値を入力してください (カンマ区切りで複数入力可)")
+                if stats['n_unique'] > cs.DISTINCT_LIMIT:
+                    user_input = st.text_input(f"{column} の値を入力してください (カンマ区切りで複数入力可)",
+                                               value=", ".join(map(str, spec['values'])) if spec else "",
+                                               help=f"要素数: {stats['n_unique']}, 出現頻度の高い値: {', '.join(map(str, stats['top_values']))}",
+                                               key=f"filter_text_{column}")
                     if user_input:
                         selected_values = [value.strip() for value in user_input.split(',')]
-                        st.session_state.df = st.session_state.df[st.session_state.df[column].isin(selected_values)]
+                        dv.set_filter(column, {'type': 'isin', 'values': selected_values})
+                    else:
+                        dv.set_filter(column, None)
                 # 要素数が少ない場合はフィルタ条件を候補から指定する
                 else:
-                    selected_values = st.multiselect(f"{column} の値を選択してください", unique_values, default=unique_values)
-                    st.session_state.df = st.session_state.df[st.session_state.df[column].isin(selected_values)]
-            elif st.session_state.df[column].dtype in ['int64', 'float64']:
-                min_value = st.session_state.df[column].min()
-                max_value = st.session_state.df[column].max()
-                selected_min_value = st.number_input(f"{column} の最小値を選択してください", min_value=min_value, max_value=max_value, value=min_value)
-                selected_max_value = st.number_input(f"{column} の最大値を選択してください", min_value=min_value, max_value=max_value, value=max_value)
-                st.session_state.df = st.session_state.df[(st.session_state.df[column] >= selected_min_value) &
-                                                        (st.session_state.df[column] <= selected_max_value)]
-            elif st.session_state.df[column].dtype == 'datetime64[ns]':
-                min_date = st.date_input(f"{column} の最小日付を選択してください", st.session_state.df[column].min())
-                max_date = st.date_input(f"{column} の最大日付を選択してください", st.session_state.df[column].max())
-                st.session_state.df = st.session_state.df[(st.session_state.df[column] >= pd.to_datetime(min_date)) &
-                                                        (st.session_state.df[column] <= pd.to_datetime(max_date))]
+                    unique_values = stats['values']
+                    selected_values = st.multiselect(f"{column} の値を選択してください", unique_values,
+                                                     default=spec['values'] if spec else unique_values,
+                                                     key=f"filter_values_{column}")
+                    # 全ての値が選択されている場合はフィルタを設定しない
+                    if len(selected_values) == len(unique_values):
+                        dv.set_filter(column, None)
+                    else:
+                        dv.set_filter(column, {'type': 'isin', 'values': list(selected_values)})
+            elif stats['kind'] == 'numeric':
+                min_value, max_value = stats['min'], stats['max']
+                quantiles_help = "四分位数: " + ", ".join(f"{value:.4g}" for value in stats['quantiles'])
+                selected_min_value = st.number_input(f"{column} の最小値を選択してください", min_value=min_value, max_value=max_value,
+                                                     value=spec['min'] if spec else min_value, help=quantiles_help,
+                                                     key=f"filter_min_{column}")
+                selected_max_value = st.number_input(f"{column} の最大値を選択してください", min_value=min_value, max_value=max_value,
+                                                     value=spec['max'] if spec else max_value, help=quantiles_help,
+                                                     key=f"filter_max_{column}")
+                # 全範囲が選択されている場合はフィルタを設定しない
+                if selected_min_value <= min_value and selected_max_value >= max_value:
+                    dv.set_filter(column, None)
+                else:
+                    dv.set_filter(column, {'type': 'range', 'min': selected_min_value, 'max': selected_max_value})
+            elif stats['kind'] == 'datetime':
+                min_value, max_value = stats['min'], stats['max']
+                min_date = st.date_input(f"{column} の最小日付を選択してください", spec['min'] if spec else min_value,
+                                         key=f"filter_min_{column}")
+                max_date = st.date_input(f"{column} の最大日付を選択してください", spec['max'] if spec else max_value,
+                                         key=f"filter_max_{column}")
+                # 最大日付は、その日の終わりまでを範囲に含める(タイムゾーン付きの場合はカラムのタイムゾーンの日付とする)
+                min_datetime = pd.to_datetime(min_date).tz_localize(min_value.tz)
+                max_datetime = (pd.to_datetime(max_date) + pd.Timedelta(days=1) - pd.Timedelta(1, unit='ns')).tz_localize(min_value.tz)
+                if min_datetime <= min_value and max_datetime >= max_value:
+                    dv.set_filter(column, None)
+                else:
+                    dv.set_filter(column, {'type': 'range', 'min': min_datetime, 'max': max_datetime})
+
+        # 設定したカラム・フィルタ条件に基づいてsession_stateのデータ・カラムを更新する
+        dv.refresh()
 
     with tab_list[1]:
         # フィルタリングされたデータを表示
@@ -105,3 +146,5 @@ else:
         st.write(st.session_state.df.head())
         # 行数と列数を出力
         st.write("データの行数・列数", st.session_state.df.shape)
+        # フィルタ後のデータをダウンロード(ファイルはボタンが押された場合のみ作成し、データの状態毎にキャッシュする)
+        download_files.download_file(st.session_state.df, "フィルタ後のデータ", key="filtered_data")